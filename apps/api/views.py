@@ -5,15 +5,25 @@ import threading
 import random
 import time
 
+from bson import json_util
+
 from apps.letterboxd import letterboxd
+from apps.tmdb.archive import replay_archive
+from apps.tmdb.fetch_queue import redrive_dead_letters
 from apps.worker.celery_tasks import redo_countries, index_movies
 from apps.app.helper import chunks, convert_country_code, start_background_process
-from apps.imdb.imdb_importer import import_imdb_ratings, import_imdb_alt_titles
+from apps.imdb.imdb_importer import import_imdb_ratings, import_imdb_alt_titles, recompute_weighted_ratings
 from apps.tmdb.tmdb_importer import download_files, fetch_tmdb_data_concurrently, import_genres, import_countries, \
     import_languages, \
-    base_import, check_which_movies_needs_update, import_providers, populate_discovery_movies
-from apps.app.db_models import Movie, Genre, SpokenLanguage, ProductionCountries, DiscoveryMovie
+    base_import, check_which_movies_needs_update, import_providers, populate_discovery_movies, \
+    fetch_tmdb_data_distributed
+from apps.app.db_models import Movie, DiscoveryMovie, STORAGE_PROFILES, get_reference_data, resolve_movie_references, \
+    attach_movie_details
+from apps.app.discovery import DISCOVERY_REBUILD_MODES
+from apps.app.search_index import index_changed_movies, reset_search_index, MOVIES_INDEX
+from apps.app.models import DetailedMovie, DiscoveryMovie as DiscoveryReadModel
 from apps.imdb import imdb_importer
+from django.conf import settings
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from apps.app.meilisearch_client import client
@@ -62,12 +72,14 @@ def get_best_movies_from_country(request, country_code):
     skip = int(request.GET.get('skip', 0))
     limit = int(request.GET.get('limit', 20))
     country_codes = convert_country_code(country_code)
-    data = get_movies_from_country_codes(country_codes, limit, skip)
-    return HttpResponse(data.to_json(), content_type='application/json')
+    data = get_movies_from_country_codes(country_codes, limit, skip).as_pymongo()
+    return HttpResponse(json_util.dumps([DiscoveryReadModel.from_document(doc).to_dict() for doc in data]),
+                        content_type='application/json')
 
 
 def get_genres(request):
-    return HttpResponse(json.dumps(Genre.objects.distinct('name')), content_type='application/json')
+    names = sorted({genre.name for genre in get_reference_data().genres.values()})
+    return HttpResponse(json.dumps(names), content_type='application/json')
 
 # Get the best movie from each country until you've gone through all countries,
 # then reset the country-list, go through everything again but get the next best film, and so on...
@@ -178,6 +190,11 @@ def import_tmdb_data(request):
     return HttpResponse(start_background_process(fetch_tmdb_data_concurrently, 'import_tmdb_data', 'TMDB data'))
 
 
+def import_tmdb_data_distributed(request):
+    return HttpResponse(start_background_process(fetch_tmdb_data_distributed, 'import_tmdb_data_distributed',
+                                                 'Distributed TMDB data'))
+
+
 def fetch_genres(request):
     return HttpResponse(start_background_process(import_genres, 'import_genres', 'TMDB genres'))
 
@@ -210,50 +227,82 @@ def check_tmdb_for_changes(request):
 
 
 def fetch_movies_data(request, ids):
-    data_list = Movie.objects(pk__in=map(lambda x: int(x), ids.split(','))).exclude(
+    docs = list(Movie.objects(pk__in=map(lambda x: int(x), ids.split(','))).exclude(
         'fetched',
         'fetched_date',
-        'data').to_json()
-    return HttpResponse(list(data_list), content_type='application/json')
+        'data').as_pymongo())
+    data = [DetailedMovie.from_document(doc).to_dict()
+            for doc in resolve_movie_references(attach_movie_details(docs))]
+    return HttpResponse(json_util.dumps(data), content_type='application/json')
 
 def fetch_movie_data(request, id):
-    try:
-        data = Movie.objects.get(id=id).to_json()
-    except Movie.DoesNotExist:
-        data = None
+    doc = Movie.objects(id=id).as_pymongo().first()
+    if doc:
+        doc = resolve_movie_references(attach_movie_details([doc]))[0]
+    data = json_util.dumps(DetailedMovie.from_document(doc).to_dict()) if doc else None
     return HttpResponse(data, content_type='application/json')
 
 
 def dump_genres(request):
-    return HttpResponse(Genre.objects.all().to_json(), content_type='application/json')
+    return __dump_statics(get_reference_data().genres)
 
 
 def dump_langs(request):
-    return HttpResponse(SpokenLanguage.objects.all().to_json(), content_type='application/json')
+    return __dump_statics(get_reference_data().langs)
 
 
 def dump_countries(request):
-    return HttpResponse(ProductionCountries.objects.all().to_json(), content_type='application/json')
+    return __dump_statics(get_reference_data().countries)
+
+
+def __dump_statics(statics: dict):
+    return HttpResponse(json_util.dumps([doc.to_mongo() for doc in statics.values()]),
+                        content_type='application/json')
 
 
 def redo_guestimation(request):
     def work():
-        for chunk in chunks(Movie.objects().all().values_list('id'), 50):
+        for chunk in chunks(Movie.objects.scalar('id'), settings.REDO_COUNTRIES_BATCH_SIZE):
             redo_countries.delay(list(chunk))
 
     return HttpResponse(start_background_process(work, 'guestimate_countries', 'Redoing Guestimation Of Countries'))
 
 
+def redo_weighted_ratings(request):
+    return HttpResponse(start_background_process(recompute_weighted_ratings, 'recompute_weighted_ratings',
+                                                 'Recomputing Weighted Ratings'))
+
+
+def redrive_failed_fetches(request):
+    return HttpResponse(start_background_process(redrive_dead_letters, 'redrive_dead_letters',
+                                                 'Re-driving dead lettered fetches'))
+
+
+def replay_tmdb_archive(request):
+    """?profile= replays with another storage profile than TMDB_STORAGE_PROFILE, for instance full to re-expand"""
+    storage_profile = request.GET.get('profile', None)
+    if storage_profile and storage_profile not in STORAGE_PROFILES:
+        return HttpResponse(json.dumps({"Message": f"Unknown storage profile: {storage_profile}"}), status=400)
+    return HttpResponse(start_background_process(lambda: replay_archive(storage_profile=storage_profile),
+                                                 'replay_archive', 'Replaying TMDB archive'))
+
+
 def populate_discovery(request):
+    """?mode= rebuilds another way than DISCOVERY_REBUILD_MODE, for instance merge to do it all inside mongo"""
+    mode = request.GET.get('mode', None)
+    if mode and mode not in DISCOVERY_REBUILD_MODES:
+        return HttpResponse(json.dumps({"Message": f"Unknown discovery rebuild mode: {mode}"}), status=400)
+
     def work():
-        populate_discovery_movies()
+        populate_discovery_movies(mode)
 
     return HttpResponse(start_background_process(work, 'discovery_index', 'Indexing Discovery Movie Collection'))
 
 
 def index_meilisearch(request):
     def work():
-        index = client.index("movies")
+        reset_search_index()
+        index = client.index(MOVIES_INDEX)
         index.delete_all_documents()
         index.update_settings({
             "searchableAttributes": [
@@ -292,8 +341,13 @@ def index_meilisearch(request):
     return HttpResponse(start_background_process(work, 'discovery_index', 'Indexing Discovery Movie Collection'))
 
 
+def index_meilisearch_changes(request):
+    return HttpResponse(start_background_process(index_changed_movies, 'index_changed_movies',
+                                                 'Indexing Changed Movies'))
+
+
 def search_movies(request, query):
-    index = client.index("movies")
+    index = client.index(MOVIES_INDEX)
     return HttpResponse(json.dumps(index.search(query)), content_type='application/json')
 
 
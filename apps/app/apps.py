@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class WorldinmoviesConfig(AppConfig):
     name = 'apps.app'
 
+    def ready(self):
+        from apps.app.db_models import get_language_territories
+        # Built once per process up front, instead of on the first guess_country
+        get_language_territories()
@@ -0,0 +1,117 @@
+import threading
+import time
+
+from channels.layers import get_channel_layer
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from apps.app.helper import log
+from apps.app.db_models import Movie, MovieDetails
+from apps.app.discovery import sync_discovery_movies
+
+
+class BulkWriter:
+    """Buffers write operations against one collection and flushes them as unordered bulk_writes,
+       whenever batch_size operations are pending or flush_interval seconds have passed since the last flush.
+       Use it as a context manager so the tail gets flushed.
+       on_flush, when given, is called with the keys the operations of each flushed batch were added with.
+    """
+
+    def __init__(self, collection, name, batch_size=500, flush_interval=5.0, layer=None, on_flush=None):
+        self.collection = collection
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.layer = layer if layer else get_channel_layer()
+        self.written = 0
+        self.failed = 0
+        self.on_flush = on_flush
+        self.__operations = []
+        self.__keys = []
+        self.__lock = threading.Lock()
+        self.__last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def __len__(self):
+        return len(self.__operations)
+
+    def add(self, operation, key=None):
+        with self.__lock:
+            self.__operations.append(operation)
+            if key is not None:
+                self.__keys.append(key)
+            if (len(self.__operations) >= self.batch_size
+                    or time.monotonic() - self.__last_flush >= self.flush_interval):
+                self.__flush()
+
+    def flush(self):
+        with self.__lock:
+            self.__flush()
+
+    def __flush(self):
+        operations, self.__operations = self.__operations, []
+        keys, self.__keys = self.__keys, []
+        self.__last_flush = time.monotonic()
+        if not operations:
+            return
+        started = time.monotonic()
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            self.written += len(operations)
+            errors = 0
+        except BulkWriteError as e:
+            result = None
+            errors = len(e.details['writeErrors'])
+            self.written += len(operations) - errors
+            self.failed += errors
+            log(layer=self.layer, message=f"{self.name}: {errors} of {len(operations)} writes failed, "
+                                          f"first error: {e.details['writeErrors'][0]['errmsg']}")
+        except PyMongoError as e:
+            # Connection errors and timeouts fail the whole batch, which must not escape from add()
+            self.failed += len(operations)
+            log(layer=self.layer, message=f"{self.name}: batch of {len(operations)} writes failed: {e}", e=e)
+            return
+        latency = (time.monotonic() - started) * 1000
+        upserted = result.upserted_count if result else 0
+        log(layer=self.layer, message=f"{self.name}: wrote batch of {len(operations) - errors} "
+                                      f"({upserted} upserted) in {latency:.0f}ms, {self.written} written in total")
+        if self.on_flush and keys:
+            self.on_flush(keys)
+
+
+class MovieWriter(BulkWriter):
+    """BulkWriter for fetched movies. With split_details, their Movie.DETAIL_FIELDS are written to movie_details
+       by a second writer alongside, and left out of the movie documents.
+       The discoverymovie rows of every flushed batch are brought up to date right after it's written.
+    """
+
+    def __init__(self, name, batch_size=500, flush_interval=5.0, split_details=False, layer=None):
+        super().__init__(Movie._get_collection(), name, batch_size, flush_interval, layer, self.__flushed)
+        self.details = BulkWriter(MovieDetails._get_collection(), f"{name} (details)", batch_size, flush_interval,
+                                  self.layer) if split_details else None
+
+    def add_movie(self, movie, selector, rating_prior, upsert=False):
+        """Queues the fetched_update of movie for the movie matching selector, and its details_update"""
+        if self.details is not None:
+            self.details.add(UpdateOne({'_id': movie.id}, movie.details_update(), upsert=True))
+        self.add(UpdateOne(selector, movie.fetched_update(*rating_prior, split_details=self.details is not None),
+                           upsert=upsert), movie.id)
+
+    def flush(self):
+        super().flush()
+        if self.details is not None:
+            self.details.flush()
+
+    def __flushed(self, movie_ids):
+        # Discovery reads the director from the details, so they have to be written first
+        if self.details is not None:
+            self.details.flush()
+        try:
+            sync_discovery_movies({'_id': {'$in': movie_ids}}, layer=self.layer)
+        except Exception as e:
+            log(layer=self.layer, message=f"{self.name}: could not sync discovery of {len(movie_ids)} movies: {e}", e=e)
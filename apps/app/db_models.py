@@ -1,16 +1,18 @@
 import decimal
-from collections import Counter
+from collections import ChainMap, Counter, namedtuple
 from typing import override
 from bson import json_util
 import pycountry
 import pytz
-import mongoengine
+import threading
+import time
 # import line_profiler
 # import atexit
 from datetime import datetime, timedelta
 from functools import lru_cache
 
 from mongoengine import DynamicDocument, QuerySet
+from pymongo import ReturnDocument, UpdateOne
 from mongoengine.fields import (ListField,
                                 EmbeddedDocumentField,
                                 EmbeddedDocument,
@@ -24,11 +26,55 @@ from babel.languages import get_official_languages, get_territory_language_info
 
 tz = pytz.timezone('Europe/Stockholm')
 
+# Default prior of the bayesian weighted rating, see Movie.calculate_weighted_rating_bayes.
+# recompute_weighted_ratings replaces the mean with the one of the whole catalogue, see RatingPrior
+WEIGHTED_RATING_MIN_VOTES = 200
+WEIGHTED_RATING_PRIOR_MEAN = 4
+
+# How often a process checks if the reference data version has moved, see get_reference_data
+REFERENCE_DATA_CHECK_SECONDS = 30
+
+# How much of the credits and images add_fetched_info keeps, see apply_storage_profile.
+# Discovery only needs the director, and search the directors and titles.
+FULL_PROFILE = 'full'
+STORAGE_PROFILES = {
+    FULL_PROFILE: None,
+    'compact': {'cast': 20,
+                'crew_jobs': {'Director', 'Screenplay', 'Writer', 'Novel', 'Producer', 'Director of Photography',
+                              'Original Music Composer', 'Editor'},
+                'images': 10},
+    'minimal': {'cast': 5, 'crew_jobs': {'Director'}, 'images': 1},
+}
+
 
 # profile = line_profiler.LineProfiler()
 # atexit.register(profile.print_stats)
 
 
+def apply_storage_profile(movie: dict, storage_profile: str) -> dict:
+    """The TMDB response with the top billed cast, the key crew jobs and the first images of each kind kept,
+       as much as the profile allows. The response itself is left untouched, so it can still be archived as is.
+    """
+    if storage_profile not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile: {storage_profile}, expected one of {list(STORAGE_PROFILES)}")
+    limits = STORAGE_PROFILES[storage_profile]
+    if not limits:
+        return movie
+    movie = dict(movie)
+    credits = movie.get('credits')
+    if credits:
+        cast = sorted(credits.get('cast') or [], key=lambda member: member.get('order') or 0)
+        movie['credits'] = dict(credits,
+                                cast=cast[:limits['cast']],
+                                crew=[member for member in credits.get('crew') or []
+                                      if member.get('job') in limits['crew_jobs']])
+    images = movie.get('images')
+    if images:
+        movie['images'] = {kind: values[:limits['images']] if isinstance(values, list) else values
+                           for kind, values in images.items()}
+    return movie
+
+
 @lru_cache(maxsize=None)
 def get_all_countries():
     country: pycountry.db.Country
@@ -40,6 +86,67 @@ def get_all_countries():
     return territories
 
 
+@lru_cache(maxsize=None)
+def get_language_territories():
+    """language -> ((territory, population_percent), ...) for every territory where the language is official,
+       ascending by the share of the population speaking it. Built once from Babel, so guess_country never
+       has to look up territories per movie.
+    """
+    table = dict()
+    for language, territories in get_all_countries().items():
+        rows = []
+        for territory in territories:
+            info = get_territory_language_info(territory).get(language, {})
+            if info.get('official_status') == 'official':
+                rows.append((territory, info.get('population_percent')))
+        rows.sort(key=lambda row: row[1])
+        table[language] = tuple(rows)
+    return table
+
+
+# @profile
+def estimate_country_of_origin(origin_country_db, original_language, production_countries, production_companies):
+    if origin_country_db and len(origin_country_db) == 1:
+        return origin_country_db[0]
+
+    # All countries that has this language as an official language, as (territory, percentage)
+    territories_with_percentage = get_language_territories().get(original_language, ())
+
+    # 0. If there's only one origin_country attribute set
+    # 1. If there's only one country related to the language
+    if len(territories_with_percentage) == 1:
+        return territories_with_percentage[0][0]
+    # 2. If there's only one country among the production_countries
+    elif len(production_countries) == 1:
+        return production_countries[0]
+    else:
+        # If original language is spoken in multiple countries, consider all of them
+        # Filter out countries where the language is spoken by less than 10% of the population
+
+        # Count occurrences of production countries within the filtered list of origin countries
+        territories_connected_to_production = [country for country in
+                                               territories_with_percentage if country[0]
+                                               in production_companies]
+        production_counter = Counter([x[0] for x in territories_connected_to_production])
+        commons = dict()
+        [commons.setdefault(x[1], []).append(x[0]) for x in production_counter.items()]
+        sorted(commons.items(), key=lambda x: x[0])
+        most_common = list(commons.items())[-1] if len(commons.items()) > 0 else commons.items()
+
+        # 3. There's a majority of production_countries, connected to the language
+        if len(most_common) > 0 and len(most_common[1]) == 1:
+            return most_common[1][0]
+        # 4. Highest ranked territory based on population speakers of this language
+        else:
+            sorted(territories_connected_to_production, key=lambda x: x[1])
+            if len(territories_connected_to_production) > 0:
+                highest_ranked_country_on_lang = territories_connected_to_production[-1][0]
+                # Pick the production country with the highest count
+                return highest_ranked_country_on_lang
+            else:
+                return None
+
+
 class Title(EmbeddedDocument):
     iso_3166_1 = StringField(max_length=8)
     title = StringField()
@@ -174,7 +281,8 @@ class ProductionCountries(DynamicDocument):
 
 class CustomQuerySet(QuerySet):
     def to_json(self):
-        return "[%s]" % (",".join([doc.to_json() for doc in self]))
+        """Serializes straight from the raw documents, with references resolved for the whole batch at once"""
+        return json_util.dumps(resolve_movie_references(list(self.as_pymongo())))
 
 
 class WatchProvider(DynamicDocument):
@@ -194,6 +302,80 @@ class WatchProvider(DynamicDocument):
                 f'"provider_name":"{self.provider_name}"}}')
 
 
+class RatingPrior(DynamicDocument):
+    id = StringField(primary_key=True)
+    min_votes = IntField()
+    mean = FloatField()
+    updated = DateTimeField()
+
+    meta = {'collection': 'rating_prior'}
+
+
+class ReferenceDataVersion(DynamicDocument):
+    id = StringField(primary_key=True)
+    version = IntField(default=0)
+    updated = DateTimeField()
+
+    meta = {'collection': 'reference_data_version'}
+
+
+ReferenceData = namedtuple('ReferenceData', ['version', 'genres', 'langs', 'countries', 'providers', 'rating_prior'])
+
+REFERENCE_DATA_KEY = 'statics'
+__reference_data = None
+__reference_data_checked = 0.0
+__reference_data_lock = threading.Lock()
+
+
+def reference_data_version():
+    doc = ReferenceDataVersion._get_collection().find_one({'_id': REFERENCE_DATA_KEY}, {'version': 1})
+    return doc['version'] if doc else 0
+
+
+def bump_reference_data_version():
+    """Call after genres, languages, countries or providers are written,
+       every process reloads its reference data the next time it checks the version.
+    """
+    global __reference_data_checked
+    doc = ReferenceDataVersion._get_collection().find_one_and_update(
+        {'_id': REFERENCE_DATA_KEY},
+        {'$inc': {'version': 1}, '$set': {'updated': datetime.now(tz)}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    with __reference_data_lock:
+        __reference_data_checked = 0.0
+    return doc['version']
+
+
+def __load_rating_prior():
+    doc = RatingPrior._get_collection().find_one({'_id': REFERENCE_DATA_KEY})
+    if doc:
+        return doc['min_votes'], doc['mean']
+    return WEIGHTED_RATING_MIN_VOTES, WEIGHTED_RATING_PRIOR_MEAN
+
+
+def get_reference_data() -> ReferenceData:
+    """Genres, languages, countries and providers held in memory, keyed by their ids,
+       along with the (m, c) prior of the weighted rating.
+       The collections are only reloaded when the version stamp has moved, which is checked
+       at most every REFERENCE_DATA_CHECK_SECONDS.
+    """
+    global __reference_data, __reference_data_checked
+    with __reference_data_lock:
+        now = time.monotonic()
+        if __reference_data is None or now - __reference_data_checked >= REFERENCE_DATA_CHECK_SECONDS:
+            version = reference_data_version()
+            if __reference_data is None or __reference_data.version != version:
+                __reference_data = ReferenceData(
+                    version=version,
+                    genres={genre.id: genre for genre in Genre.objects.all()},
+                    langs={lang.iso_639_1: lang for lang in SpokenLanguage.objects.all()},
+                    countries={country.iso_3166_1: country for country in ProductionCountries.objects.all()},
+                    providers={provider.provider_id: provider for provider in WatchProvider.objects.all()},
+                    rating_prior=__load_rating_prior())
+            __reference_data_checked = now
+        return __reference_data
+
+
 class EmbeddedProvider(EmbeddedDocument):
     provider = ReferenceField(WatchProvider, dbref=True)
     provider_type = StringField()
@@ -260,18 +442,39 @@ class Movie(DynamicDocument):
     recommended_movies = ListField(IntField())
     providers = ListField(EmbeddedDocumentField(ProvidersByCountry))
     guessed_country = StringField()
+    claimed_by = StringField()
+    lease_expiry = DateTimeField()
+    fetch_priority = FloatField(default=0)
+    # The STORAGE_PROFILES entry credits and images were trimmed with
+    storage_profile = StringField()
+    # Last time the movie was fetched, rated, retitled or re-guessed, the watermark of index_changed_movies
+    updated_date = DateTimeField()
 
     meta = {'indexes': [
         'imdb_id', 
         'weighted_rating', 
         'guessed_country', 
         ('guessed_country', '-weighted_rating'),
-        ('fetched', 'guessed_country', '_id')],
+        ('fetched', 'guessed_country', '_id'),
+        ('fetched', '-fetch_priority', 'lease_expiry'),
+        'updated_date'],
             'queryset_class': CustomQuerySet}
 
+    # Written by the IMDB imports, and derived from them, rather than by add_fetched_info
+    IMDB_FIELDS = ('imdb_vote_average', 'imdb_vote_count', 'weighted_rating')
+    # Fetch queue bookkeeping, never served by the api
+    QUEUE_FIELDS = ('claimed_by', 'lease_expiry', 'fetch_priority')
+    # Search indexing bookkeeping, never served by the api either
+    INDEXER_FIELDS = ('updated_date',)
+    # Large and only served by the detailed view, so they can live in movie_details instead, see MovieDetails
+    DETAIL_FIELDS = ('credits', 'images', 'providers', 'recommended_movies')
+
     def add_fetched_info(self, movie: dict, all_genres: dict[Genre],
                          all_langs: dict[SpokenLanguage],
-                         all_countries: dict[ProductionCountries]):
+                         all_countries: dict[ProductionCountries],
+                         storage_profile: str = FULL_PROFILE):
+        movie = apply_storage_profile(movie, storage_profile)
+        self.storage_profile = storage_profile
         self.fetched = True
         self.fetched_date = datetime.now(tz)
         self.add_references(movie, all_genres, all_langs, all_countries)
@@ -323,7 +526,7 @@ class Movie(DynamicDocument):
                 providers_by_country.append(ProvidersByCountry(country_code=k, providers=providers))
         return providers_by_country
 
-    def calculate_weighted_rating_bayes(self):
+    def calculate_weighted_rating_bayes(self, m=WEIGHTED_RATING_MIN_VOTES, c=WEIGHTED_RATING_PRIOR_MEAN):
         """
         The formula for calculating the Top Rated 250 Titles gives a true Bayesian estimate:
         weighted rating (WR) = (v ÷ (v+m)) × R + (m ÷ (v+m)) × C where:
@@ -334,69 +537,65 @@ class Movie(DynamicDocument):
         C = the mean vote across the whole report (currently 7.0)
         """
         v = decimal.Decimal(self.vote_count) + decimal.Decimal(self.imdb_vote_count)
-        m = decimal.Decimal(200)
+        m = decimal.Decimal(m)
         if self.imdb_vote_count > 0:
             r = (decimal.Decimal(self.vote_average) + decimal.Decimal(self.imdb_vote_average)) / 2
         else:
             r = decimal.Decimal(self.vote_average)
-        c = decimal.Decimal(4)
+        c = decimal.Decimal(c)
         self.weighted_rating = float((v / (v + m)) * r + (m / (v + m)) * c)
 
-    def guess_country(self):
-        # @profile
-        def estimate_country_of_origin(origin_country_db, original_language, production_countries,
-                                       production_companies):
-            if origin_country_db and len(origin_country_db) == 1:
-                return origin_country_db[0]
-
-            terrs = get_all_countries().get(original_language, [])
-
-            territories_with_percentage = []
-            # Get all countries that has this language as an official language
-            for territory in terrs:
-                infos = get_territory_language_info(territory)
-                for info in infos.items():
-                    official_status = info[1].get('official_status')
-                    percentage = info[1].get('population_percent')
-                    if info[0] == original_language and official_status == 'official':
-                        territories_with_percentage.append({"territory": territory, "percentage": percentage})
-
-            territories_with_percentage.sort(key=lambda item: item.get('percentage'))
-
-            # 0. If there's only one origin_country attribute set
-            # 1. If there's only one country related to the language
-            if len(territories_with_percentage) == 1:
-                return territories_with_percentage[0].get('territory')
-            # 2. If there's only one country among the production_countries
-            elif len(production_countries) == 1:
-                return production_countries[0]
-            else:
-                # If original language is spoken in multiple countries, consider all of them
-                # Filter out countries where the language is spoken by less than 10% of the population
-
-                # Count occurrences of production countries within the filtered list of origin countries
-                territories_connected_to_production = [country for country in
-                                                       territories_with_percentage if country.get('territory')
-                                                       in production_companies]
-                production_counter = Counter([x.get('territory') for x in territories_connected_to_production])
-                commons = dict()
-                [commons.setdefault(x[1], []).append(x[0]) for x in production_counter.items()]
-                sorted(commons.items(), key=lambda x: x[0])
-                most_common = list(commons.items())[-1] if len(commons.items()) > 0 else commons.items()
-
-                # 3. There's a majority of production_countries, connected to the language
-                if len(most_common) > 0 and len(most_common[1]) == 1:
-                    return most_common[1][0]
-                # 4. Highest ranked territory based on population speakers of this language
-                else:
-                    sorted(territories_connected_to_production, key=lambda x: x.get('percentage'))
-                    if len(territories_connected_to_production) > 0:
-                        highest_ranked_country_on_lang = territories_connected_to_production[-1].get('territory')
-                        # Pick the production country with the highest count
-                        return highest_ranked_country_on_lang
-                    else:
-                        return None
+    @staticmethod
+    def rating_expressions():
+        """(v, R) of calculate_weighted_rating_bayes as aggregation expressions"""
+        imdb_count = {'$ifNull': ['$imdb_vote_count', 0]}
+        tmdb_average = {'$ifNull': ['$vote_average', 0]}
+        v = {'$add': [{'$ifNull': ['$vote_count', 0]}, imdb_count]}
+        r = {'$cond': [{'$gt': [imdb_count, 0]},
+                       {'$divide': [{'$add': [tmdb_average, {'$ifNull': ['$imdb_vote_average', 0]}]}, 2]},
+                       tmdb_average]}
+        return v, r
+
+    @staticmethod
+    def weighted_rating_expression(m=WEIGHTED_RATING_MIN_VOTES, c=WEIGHTED_RATING_PRIOR_MEAN):
+        """calculate_weighted_rating_bayes as an aggregation expression, for computing it server side"""
+        v, r = Movie.rating_expressions()
+        return {'$add': [{'$multiply': [{'$divide': [v, {'$add': [v, m]}]}, r]},
+                         {'$multiply': [{'$divide': [m, {'$add': [v, m]}]}, c]}]}
+
+    def fetched_update(self, m=WEIGHTED_RATING_MIN_VOTES, c=WEIGHTED_RATING_PRIOR_MEAN, split_details=False):
+        """Update pipeline writing what add_fetched_info produced, without having read the stored document.
+           IMDB ratings are left as stored, and weighted_rating is recomputed server side against them,
+           with the prior m and c.
+           With split_details the DETAIL_FIELDS are removed from the movie, and go in details_update instead.
+        """
+        document = self.to_mongo().to_dict()
+        document.pop('_id', None)
+        for field in self.IMDB_FIELDS:
+            document.pop(field, None)
+        if split_details:
+            for field in self.DETAIL_FIELDS:
+                document.pop(field, None)
+        unset = [field.db_field for name, field in self._fields.items()
+                 if field.db_field not in document and field.db_field != '_id' and name not in self.IMDB_FIELDS]
+        pipeline = [{'$set': {key: {'$literal': value} for key, value in document.items()}}]
+        if unset:
+            pipeline.append({'$unset': unset})
+        pipeline.append({'$set': {'weighted_rating': self.weighted_rating_expression(m, c), 'updated_date': '$$NOW'}})
+        return pipeline
+
+    def details_update(self):
+        """Update pipeline writing the DETAIL_FIELDS to the movie_details document of this movie,
+           unless a newer fetch is stored there already. Upsert it.
+        """
+        document = self.to_mongo().to_dict()
+        details = {field: document[field] for field in self.DETAIL_FIELDS if field in document}
+        details.update(_id=self.id, fetched_date=self.fetched_date)
+        return [{'$replaceWith': {'$cond': [{'$gt': ['$fetched_date', self.fetched_date]},
+                                            '$$ROOT',
+                                            {'$literal': details}]}}]
 
+    def guess_country(self):
         orig_lang = self.original_language
         if orig_lang:
             return estimate_country_of_origin(self.origin_country,
@@ -404,6 +603,22 @@ class Movie(DynamicDocument):
                                               [x['iso_3166_1'] for x in self.production_countries if x],
                                               [x['origin_country'] for x in self.production_companies])
 
+    # Raw document fields guess_country_of_document needs
+    COUNTRY_FIELDS = {'original_language': 1, 'origin_country': 1, 'production_countries': 1,
+                      'production_companies.origin_country': 1, 'guessed_country': 1}
+
+    @staticmethod
+    def guess_country_of_document(doc: dict):
+        """guess_country for a raw movie document, projected with COUNTRY_FIELDS.
+           Production countries are read from their DBRef ids, so nothing gets dereferenced.
+        """
+        orig_lang = doc.get('original_language')
+        if orig_lang:
+            return estimate_country_of_origin(doc.get('origin_country'),
+                                              orig_lang,
+                                              [ref.id for ref in doc.get('production_countries') or [] if ref],
+                                              [x.get('origin_country') for x in doc.get('production_companies') or []])
+
     def add_references(self,
                        data: dict,
                        all_genres: dict[Genre],
@@ -416,32 +631,7 @@ class Movie(DynamicDocument):
 
     @override
     def to_json(self):
-        data = self.to_mongo()
-        for i, genre in enumerate(data['genres']):
-            data['genres'][i] = self.genres[i].to_mongo()
-        for i, country in enumerate(data['production_countries']):
-            x: dict = self.production_countries[i]
-            data['production_countries'][i] = {
-                "iso": x['iso_3166_1'],
-                "name": x['english_name'] if hasattr(x, 'english_name') else x['name']
-            }
-        for i, langs in enumerate(data['spoken_languages']):
-            x: dict = self.spoken_languages[i]
-            data['spoken_languages'][i] = {
-                "iso": x['iso_639_1'],
-                "name": x['english_name'] if hasattr(x, 'english_name') else x['name']
-            }
-        for a, providers_by_country in enumerate(data['providers']):
-            for b, provider in enumerate(providers_by_country['providers']):
-                try:
-                    x: dict = self.providers[a].providers[b].provider
-                    data['providers'][a]['providers'][b] = dict(provider_type=provider['provider_type'],
-                                                                name=x['provider_name'],
-                                                                logo_path=x['logo_path'])
-                except mongoengine.errors.DoesNotExist:
-                    pass
-
-        return json_util.dumps(data)
+        return json_util.dumps(resolve_movie_references([self.to_mongo().to_dict()])[0])
 
     @override
     def __str__(self):
@@ -458,6 +648,118 @@ class Movie(DynamicDocument):
                 )
 
 
+class MovieDetails(DynamicDocument):
+    """The Movie.DETAIL_FIELDS of a movie, keyed by its id, when TMDB_SPLIT_MOVIE_DETAILS is on.
+       Keeps the movie collection small, so scans by batch jobs and the cache only carry the hot fields.
+    """
+    id = IntField(primary_key=True)
+    fetched_date = DateTimeField()
+
+    meta = {'collection': 'movie_details'}
+
+
+class DeletedMovie(DynamicDocument):
+    """Tombstone of a movie deleted from mongo, until index_changed_movies has removed it from search"""
+    id = IntField(primary_key=True)
+    deleted_date = DateTimeField()
+
+    meta = {'collection': 'deleted_movie',
+            'indexes': [
+                {
+                    'name': 'TTL_index',
+                    'fields': ['deleted_date'],
+                    'expireAfterSeconds': 30 * 24 * 60 * 60
+                }
+            ]}
+
+
+def record_deleted_movies(movie_ids):
+    now = datetime.now(tz)
+    operations = [UpdateOne({'_id': movie_id}, {'$set': {'deleted_date': now}}, upsert=True) for movie_id in movie_ids]
+    if operations:
+        DeletedMovie._get_collection().bulk_write(operations, ordered=False)
+
+
+class SearchIndexState(DynamicDocument):
+    """How far index_changed_movies got, keyed by meilisearch index, and which run holds the lease to move it"""
+    id = StringField(primary_key=True)
+    watermark = DateTimeField()
+    leased_by = StringField()
+    lease_expiry = DateTimeField()
+
+    meta = {'collection': 'search_index_state'}
+
+
+def attach_movie_details(docs: list[dict], projection: dict = None) -> list[dict]:
+    """Fills in the DETAIL_FIELDS of raw movie documents from movie_details, in place, with one query for the
+       whole batch. Fields already on a movie, as stored before the split, are kept.
+    """
+    projection = projection if projection else {field: 1 for field in Movie.DETAIL_FIELDS}
+    fields = {key.split('.')[0] for key in projection}
+    ids = [doc['_id'] for doc in docs if any(field not in doc for field in fields)]
+    if not ids:
+        return docs
+    details = {doc['_id']: doc for doc in MovieDetails._get_collection().find({'_id': {'$in': ids}}, projection)}
+    for doc in docs:
+        for field, value in details.get(doc['_id'], {}).items():
+            if field != '_id':
+                doc.setdefault(field, value)
+    return docs
+
+
+def resolve_movie_references(docs: list[dict]) -> list[dict]:
+    """Replaces the genre, country, language and provider DBRefs of raw movie documents with what the api
+       serves, in place. References come from the reference data cache, and whatever it lacks is loaded
+       with one query per referenced collection for the whole batch, so nothing is dereferenced per movie.
+    """
+    statics = get_reference_data()
+    genre_ids, country_ids, lang_ids, provider_ids = set(), set(), set(), set()
+    for doc in docs:
+        genre_ids.update(ref.id for ref in doc.get('genres') or [] if ref)
+        country_ids.update(ref.id for ref in doc.get('production_countries') or [] if ref)
+        lang_ids.update(ref.id for ref in doc.get('spoken_languages') or [] if ref)
+        for providers_by_country in doc.get('providers') or []:
+            provider_ids.update(provider['provider'].id for provider in providers_by_country.get('providers') or []
+                                if provider.get('provider'))
+    genres = __with_missing(Genre, statics.genres, genre_ids)
+    countries = __with_missing(ProductionCountries, statics.countries, country_ids)
+    langs = __with_missing(SpokenLanguage, statics.langs, lang_ids)
+    providers = __with_missing(WatchProvider, statics.providers, provider_ids)
+
+    for doc in docs:
+        for field in Movie.QUEUE_FIELDS + Movie.INDEXER_FIELDS:
+            doc.pop(field, None)
+        if 'genres' in doc:
+            doc['genres'] = [genres[ref.id].to_mongo() for ref in doc['genres'] or [] if ref and ref.id in genres]
+        if 'production_countries' in doc:
+            doc['production_countries'] = [{
+                "iso": x['iso_3166_1'],
+                "name": x['english_name'] if hasattr(x, 'english_name') else x['name']
+            } for x in (countries[ref.id] for ref in doc['production_countries'] or [] if ref and ref.id in countries)]
+        if 'spoken_languages' in doc:
+            doc['spoken_languages'] = [{
+                "iso": x['iso_639_1'],
+                "name": x['english_name'] if hasattr(x, 'english_name') else x['name']
+            } for x in (langs[ref.id] for ref in doc['spoken_languages'] or [] if ref and ref.id in langs)]
+        for providers_by_country in doc.get('providers') or []:
+            for b, provider in enumerate(providers_by_country.get('providers') or []):
+                ref = provider.get('provider')
+                if ref and ref.id in providers:
+                    x = providers[ref.id]
+                    providers_by_country['providers'][b] = dict(provider_type=provider['provider_type'],
+                                                                name=x['provider_name'],
+                                                                logo_path=x['logo_path'])
+    return docs
+
+
+def __with_missing(document_class, cached: dict, ids: set):
+    """The cached documents, plus the ones among ids the cache lacks, loaded with a single query"""
+    missing = [i for i in ids if i not in cached]
+    if not missing:
+        return cached
+    return ChainMap({doc.pk: doc for doc in document_class.objects(pk__in=missing)}, cached)
+
+
 class Log(DynamicDocument):
     meta = {'collection': 'log',
             'indexes': [
@@ -481,6 +783,18 @@ class Log(DynamicDocument):
         return f"id:{self.pk}, type:{self.type}, message:{self.message}, timestamp: {self.timestamp}, ttl: {self.ttl}"
 
 
+class FetchDeadLetter(DynamicDocument):
+    id = IntField(primary_key=True)
+    attempts = IntField()
+    error = StringField()
+    failed_at = DateTimeField()
+
+    meta = {'collection': 'fetch_dead_letter'}
+
+    def __str__(self):
+        return f"id:{self.id}, attempts:{self.attempts}, error:{self.error}, failed_at:{self.failed_at}"
+
+
 class DiscoveryMovie(DynamicDocument):
     id = IntField(primary_key=True, required=True)
     imdb_id = StringField()
@@ -0,0 +1,160 @@
+import concurrent.futures
+import math
+import time
+from datetime import datetime
+
+from channels.layers import get_channel_layer
+from pymongo import DeleteOne, ReplaceOne
+
+from apps.app.helper import log
+from apps.app.db_models import Movie, MovieDetails, Genre, DiscoveryMovie, DeletedMovie, attach_movie_details, \
+    resolve_movie_references, tz
+from apps.app.models import DiscoveryMovie as DiscoveryReadModel
+
+# How populate_discovery_movies rebuilds discoverymovie: 'tasks' projects chunks of movies in celery workers,
+# 'merge' runs the projection inside mongo, see merge_discovery_movies, and 'shadow' merges into a fresh collection
+# that then replaces the live one, see rebuild_discovery_shadow
+DISCOVERY_REBUILD_MODES = ('tasks', 'merge', 'shadow')
+SHADOW_SUFFIX = '_shadow'
+
+
+def discovery_documents(selector: dict):
+    """Yields (id, discoverymovie document) for the movies matching selector, with None as the document
+       of movies that don't belong in discovery
+    """
+    movies = list(Movie._get_collection().find(selector, DiscoveryReadModel.MOVIE_FIELDS))
+    attach_movie_details(movies, {'credits.crew.name': 1, 'credits.crew.job': 1})
+    for movie in resolve_movie_references(movies):
+        if DiscoveryReadModel.belongs_in_discovery(movie):
+            yield movie['_id'], DiscoveryReadModel.from_movie(movie).to_dict()
+        else:
+            yield movie['_id'], None
+
+
+def discovery_operations(selector: dict) -> list:
+    """Writes bringing the discoverymovie rows of the movies matching selector up to date:
+       a ReplaceOne for every movie that belongs in discovery, and a DeleteOne for every one that doesn't.
+    """
+    return [ReplaceOne({'_id': movie_id}, document, upsert=True) if document else DeleteOne({'_id': movie_id})
+            for movie_id, document in discovery_documents(selector)]
+
+
+def sync_discovery_movies(selector: dict, layer=None):
+    """Keeps discoverymovie in step with the movies matching selector, right after they were written,
+       so the full populate_discovery_movies rebuild is only needed for repairs.
+       Returns the number of rows written and deleted.
+    """
+    operations = discovery_operations(selector)
+    if not operations:
+        return 0, 0
+    result = DiscoveryMovie._get_collection().bulk_write(operations, ordered=False)
+    written = result.upserted_count + result.matched_count
+    log(layer=layer if layer else get_channel_layer(),
+        message=f"Synced discovery of {len(operations)} movies, {written} written and "
+                f"{result.deleted_count} deleted")
+    return written, result.deleted_count
+
+
+def discovery_pipeline(selector: dict) -> list:
+    """DiscoveryMovie.from_movie as an aggregation over the movies matching selector that belong in discovery.
+       The director is picked from credits, or from movie_details when they're split out, and genre names are
+       looked up, all server side.
+    """
+    crew = {'$ifNull': ['$credits.crew', {'$ifNull': [{'$first': '$details.credits.crew'}, []]}]}
+    return [
+        {'$match': dict(selector, fetched=True, guessed_country={'$nin': [None, '']})},
+        {'$project': {'imdb_id': 1, 'original_title': 1, 'title': 1, 'poster_path': 1, 'vote_average': 1,
+                      'vote_count': 1, 'guessed_country': 1, 'release_date': 1, 'weighted_rating': 1, 'overview': 1,
+                      'credits.crew.name': 1, 'credits.crew.job': 1,
+                      'genre_ids': {'$map': {'input': {'$ifNull': ['$genres', []]},
+                                             'in': {'$getField': {'field': {'$literal': '$id'}, 'input': '$$this'}}}}}},
+        {'$lookup': {'from': MovieDetails._get_collection_name(), 'localField': '_id', 'foreignField': '_id',
+                     'pipeline': [{'$project': {'credits.crew.name': 1, 'credits.crew.job': 1}}],
+                     'as': 'details'}},
+        {'$lookup': {'from': Genre._get_collection_name(), 'localField': 'genre_ids', 'foreignField': '_id',
+                     'as': 'genre_docs'}},
+        {'$set': {'director': {'$first': {'$filter': {'input': crew,
+                                                      'cond': {'$eq': ['$$this.job', 'Director']},
+                                                      'limit': 1}}}}},
+        {'$project': {
+            'imdb_id': 1,
+            'original_title': 1,
+            'english_title': {'$ifNull': ['$title', '']},
+            'poster_path': 1,
+            'vote_average': {'$ifNull': ['$vote_average', 0.0]},
+            'vote_count': {'$ifNull': ['$vote_count', 0]},
+            'estimated_country': '$guessed_country',
+            'year': {'$cond': [{'$gt': [{'$strLenCP': {'$ifNull': ['$release_date', '']}}, 0]},
+                               {'$substrCP': ['$release_date', 0, 4]},
+                               '$$REMOVE']},
+            'director': '$director.name',
+            'genres': {'$map': {'input': {'$filter': {'input': '$genre_ids',
+                                                      'cond': {'$in': ['$$this', '$genre_docs._id']}}},
+                                'in': {'$arrayElemAt': ['$genre_docs.name',
+                                                        {'$indexOfArray': ['$genre_docs._id', '$$this']}]}}},
+            'weighted_rating': {'$ifNull': ['$weighted_rating', 0.0]},
+            'overview': 1}},
+    ]
+
+
+def merge_discovery_movies(lower: int, upper: int, into: str = None, layer=None):
+    """Rebuilds the discoverymovie rows of the movies with lower <= id < upper in one aggregation, $merged into
+       discoverymovie, or the into collection, without a movie leaving mongo.
+       Id ranges don't overlap, so they can be merged in parallel.
+    """
+    started = time.monotonic()
+    pipeline = discovery_pipeline({'_id': {'$gte': lower, '$lt': upper}})
+    pipeline.append({'$merge': {'into': into if into else DiscoveryMovie._get_collection_name(), 'on': '_id',
+                                'whenMatched': 'replace', 'whenNotMatched': 'insert'}})
+    Movie._get_collection().aggregate(pipeline, allowDiskUse=True)
+    log(layer=layer if layer else get_channel_layer(),
+        message=f"Merged discovery of ids {lower} to {upper} in {time.monotonic() - started:.1f}s")
+
+
+def id_ranges(partitions: int) -> list:
+    """Splits the ids of fetched movies into partitions [lower, upper) ranges of equal width"""
+    collection = Movie._get_collection()
+    first = collection.find_one({'fetched': True}, {'_id': 1}, sort=[('_id', 1)])
+    last = collection.find_one({'fetched': True}, {'_id': 1}, sort=[('_id', -1)])
+    if not first:
+        return []
+    width = max(1, math.ceil((last['_id'] - first['_id'] + 1) / partitions))
+    return [(lower, min(lower + width, last['_id'] + 1)) for lower in range(first['_id'], last['_id'] + 1, width)]
+
+
+def rebuild_discovery_shadow(partitions: int, workers: int, layer=None):
+    """Rebuilds discoverymovie from scratch into a shadow collection, and renames it over the live one.
+       The shadow gets its secondary indexes once it's complete instead of maintaining them on every write,
+       live queries never see a half built collection, and rows of movies no longer in discovery are dropped.
+       Movies written or deleted during the rebuild were synced to the collection the shadow replaced,
+       so they are synced again once it's swapped in.
+    """
+    layer = layer if layer else get_channel_layer()
+    started = time.monotonic()
+    live = DiscoveryMovie._get_collection()
+    # updated_date is stamped by mongo, tombstones by this process, so each is compared against its own clock
+    server_started_at = live.database.command('hello')['localTime']
+    started_at = datetime.now(tz)
+    shadow_name = live.name + SHADOW_SUFFIX
+    live.database.drop_collection(shadow_name)
+    shadow = live.database.create_collection(shadow_name)
+    ranges = id_ranges(partitions)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(lambda bounds: merge_discovery_movies(*bounds, into=shadow_name, layer=layer), ranges):
+            pass
+    for spec in DiscoveryMovie._meta['index_specs']:
+        options = dict(spec)
+        fields = options.pop('fields')
+        options.pop('cls', None)
+        shadow.create_index(fields, **options)
+    rows = shadow.estimated_document_count()
+    shadow.rename(live.name, dropTarget=True)
+
+    written, _ = sync_discovery_movies({'updated_date': {'$gte': server_started_at}}, layer=layer)
+    deleted_ids = [doc['_id'] for doc in DeletedMovie._get_collection().find({'deleted_date': {'$gte': started_at}},
+                                                                              {'_id': 1})]
+    deleted = live.delete_many({'_id': {'$in': deleted_ids}}).deleted_count if deleted_ids else 0
+    log(layer=layer, message=f"Swapped in a rebuilt discoverymovie of {rows} movies from {len(ranges)} id ranges "
+                             f"in {time.monotonic() - started:.1f}s, then re-synced {written} and removed {deleted} "
+                             f"movies written during the rebuild")
+    return rows
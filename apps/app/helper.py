@@ -3,12 +3,14 @@ import traceback
 import datetime
 import json
 import threading
+import time
+import zlib
 
 from itertools import chain, islice
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
-from apps.app.db_models import Genre, SpokenLanguage, ProductionCountries
+from apps.app.db_models import get_reference_data
 
 
 def convert_country_code(country_code):
@@ -116,12 +118,43 @@ def __unzip_file(file_name):
         return file.readlines()
 
 
-def get_statics():
-    all_genres = dict[Genre]([(gen.id, gen) for gen
-                              in Genre.objects.all()])
-    all_langs = dict[SpokenLanguage]([(lang.iso_639_1, lang) for lang
-                                      in SpokenLanguage.objects.all()])
-    all_countries = dict[ProductionCountries]([(country.iso_3166_1, country) for country
-                                               in ProductionCountries.objects.all()])
-    return all_genres, all_langs, all_countries
+def __stream_gzip_lines(response, chunk_size=1024 * 1024):
+    """Decompresses a streamed gzip http response and yields it line by line,
+       so only one network chunk and one partial line is held in memory at a time.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b''
+    for compressed in response.iter_content(chunk_size=chunk_size):
+        pending += decompressor.decompress(compressed)
+        # Concatenated gzip members are valid gzip, start over on the next member
+        while decompressor.unused_data:
+            leftover = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            pending += decompressor.decompress(leftover)
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line.decode('utf-8')
+    pending += decompressor.flush()
+    if pending:
+        yield pending.decode('utf-8')
+
+
+def __log_throughput(iterable, message, every=100000, layer=None):
+    layer = layer if layer else get_channel_layer()
+    started = time.monotonic()
+    count = 0
+    for item in iterable:
+        count += 1
+        if count % every == 0:
+            rate = count / max(time.monotonic() - started, 1e-9)
+            log(layer=layer, message=f"{message}: {count} lines processed, {rate:.0f} lines/s")
+        yield item
+    elapsed = time.monotonic() - started
+    log(layer=layer, message=f"{message}: done with {count} lines in {elapsed:.1f}s, "
+                             f"{count / max(elapsed, 1e-9):.0f} lines/s")
 
+
+def get_statics():
+    """(genres, languages, countries) keyed by id, served from the process wide reference data cache"""
+    statics = get_reference_data()
+    return statics.genres, statics.langs, statics.countries
@@ -1,8 +1,40 @@
 from apps.app.db_models import Movie
 
 
-class BelongsToCollection:
-    def __init__(self, 
+class ReadModel:
+    """Plain read model hydrated straight from a raw pymongo document, without building a mongoengine document.
+       The attributes are the __slots__, read from the document key of the same name.
+    """
+    __slots__ = ()
+    # Attributes stored under another key in mongo
+    DOCUMENT_KEYS = {'id': '_id'}
+    # Leave unset attributes out of to_dict, like mongo leaves them out of the document
+    OMIT_EMPTY = False
+
+    @classmethod
+    def from_document(cls, doc: dict):
+        model = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(model, name, doc.get(cls.DOCUMENT_KEYS.get(name, name)))
+        return model
+
+    @classmethod
+    def projection(cls) -> dict:
+        return {cls.DOCUMENT_KEYS.get(name, name): 1 for name in cls.__slots__}
+
+    def to_dict(self) -> dict:
+        data = dict()
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None or not self.OMIT_EMPTY:
+                data[self.DOCUMENT_KEYS.get(name, name)] = value
+        return data
+
+
+class BelongsToCollection(ReadModel):
+    __slots__ = ('id', 'name', 'poster_path', 'backdrop_path')
+
+    def __init__(self,
         id,
         name,
         poster_path,
@@ -12,8 +44,10 @@ class BelongsToCollection:
         self.poster_path = poster_path
         self.backdrop_path = backdrop_path
 
-class ProductionCompany:
-    def __init__(self, 
+class ProductionCompany(ReadModel):
+    __slots__ = ('id', 'logo_path', 'name', 'origin_country')
+
+    def __init__(self,
         id,
         logo_path,
         name,
@@ -23,32 +57,42 @@ class ProductionCompany:
         self.name = name
         self.origin_country = origin_country
 
-class ProductionCountries:
-    def __init__(self, 
-        iso, 
+class ProductionCountries(ReadModel):
+    __slots__ = ('iso', 'name')
+
+    def __init__(self,
+        iso,
         name):
         self.iso = iso
         self.name = name
 
-class Crew:
+class Crew(ReadModel):
+    __slots__ = ('id',)
+
     def __init__(self, id):
         self.id = id
 
-class Cast:
+class Cast(ReadModel):
+    __slots__ = ('id',)
+
     def __init__(self, id):
         self.id = id
 
 
-class Credit:
-    def __init__(self, 
-        crew: list[Crew], 
+class Credit(ReadModel):
+    __slots__ = ('crew', 'cast')
+
+    def __init__(self,
+        crew: list[Crew],
         cast: list[Cast]):
         self.crew = crew
         self.cast = cast
 
 
-class ExternalIDs:
-    def __init__(self, 
+class ExternalIDs(ReadModel):
+    __slots__ = ('id', 'imdb_id', 'facebook_id', 'instagram_id', 'twitter_id', 'wikidata_id')
+
+    def __init__(self,
         id,
         imdb_id,
         facebook_id,
@@ -63,13 +107,26 @@ class ExternalIDs:
         self.wikidata_id = wikidata_id
 
 
-class Provider:
+class Provider(ReadModel):
+    __slots__ = ('id',)
+
     def __init__(self, id):
         self.id = id
 
 
-class DetailedMovie:
-    def __init__(self, 
+class DetailedMovie(ReadModel):
+    """The /movie/<id> view of a movie. Embedded parts are kept as the raw subdocuments they were read as,
+       references are expected to be resolved already, see resolve_movie_references.
+    """
+    __slots__ = ('id', 'fetched', 'fetched_date', 'backdrop_path', 'belongs_to_collection', 'budget', 'genres',
+                 'homepage', 'imdb_id', 'original_language', 'origin_country', 'original_title', 'overview',
+                 'popularity', 'poster_path', 'production_companies', 'production_countries', 'release_date',
+                 'revenue', 'runtime', 'spoken_languages', 'status', 'tagline', 'title', 'video', 'vote_average',
+                 'vote_count', 'imdb_vote_average', 'imdb_vote_count', 'weighted_rating', 'alternative_titles',
+                 'credits', 'external_ids', 'images', 'recommended_movies', 'providers', 'guessed_country')
+    OMIT_EMPTY = True
+
+    def __init__(self,
         id,
         fetched: bool,
         fetched_date,
@@ -147,11 +204,21 @@ class DetailedMovie:
 
 
 
-class SearchMovie:
-    def __init__(self, 
-        id, 
+class SearchMovie(ReadModel):
+    """The document indexed in meilisearch, built from a movie projected with SearchMovie.FIELDS"""
+    __slots__ = ('id', 'title', 'original_title', 'alternative_titles', 'overview', 'directors', 'weighted_rating',
+                 'vote_average', 'vote_count', 'guessed_country', 'original_language', 'poster', 'year')
+    DOCUMENT_KEYS = {}
+    FIELDS = {'title': 1, 'original_title': 1, 'alternative_titles.titles.title': 1, 'overview': 1,
+              'credits.crew.name': 1, 'credits.crew.job': 1, 'weighted_rating': 1, 'vote_average': 1,
+              'imdb_vote_average': 1, 'vote_count': 1, 'imdb_vote_count': 1, 'guessed_country': 1,
+              'original_language': 1, 'poster_path': 1, 'release_date': 1}
+
+    def __init__(self,
+        id,
         title,
         original_title,
+        alternative_titles,
         overview,
         directors,
         weighted_rating,
@@ -164,6 +231,7 @@ class SearchMovie:
         self.id = id
         self.title = title
         self.original_title = original_title
+        self.alternative_titles = alternative_titles
         self.overview = overview
         self.directors = directors
         self.weighted_rating = weighted_rating
@@ -174,21 +242,47 @@ class SearchMovie:
         self.poster = poster
         self.year = year
 
+    @classmethod
+    def from_document(cls, doc: dict):
+        crew = (doc.get('credits') or {}).get('crew') or []
+        titles = (doc.get('alternative_titles') or {}).get('titles') or []
+        return cls(id=doc['_id'],
+                   title=doc.get('title'),
+                   original_title=doc.get('original_title'),
+                   alternative_titles=[title['title'] for title in titles if title.get('title')],
+                   overview=doc.get('overview'),
+                   directors=[member.get('name') for member in crew if member.get('job') == "Director"],
+                   weighted_rating=doc.get('weighted_rating'),
+                   vote_average=((doc.get('vote_average') or 0) + (doc.get('imdb_vote_average') or 0)) / 2,
+                   vote_count=(doc.get('vote_count') or 0) + (doc.get('imdb_vote_count') or 0),
+                   guessed_country=doc.get('guessed_country'),
+                   original_language=doc.get('original_language'),
+                   poster=doc.get('poster_path'),
+                   year=(doc.get('release_date') or '')[:4])
+
+
+class DiscoveryMovie(ReadModel):
+    """A row of the discoverymovie collection, built from a movie projected with DiscoveryMovie.MOVIE_FIELDS"""
+    __slots__ = ('id', 'imdb_id', 'original_title', 'english_title', 'poster_path', 'vote_average', 'vote_count',
+                 'estimated_country', 'year', 'director', 'genres', 'weighted_rating', 'overview')
+    OMIT_EMPTY = True
+    MOVIE_FIELDS = {'fetched': 1, 'imdb_id': 1, 'original_title': 1, 'title': 1, 'poster_path': 1, 'vote_average': 1,
+                    'vote_count': 1, 'guessed_country': 1, 'release_date': 1, 'credits.crew.name': 1,
+                    'credits.crew.job': 1, 'genres': 1, 'weighted_rating': 1, 'overview': 1}
 
-class DiscoveryMovie:
-    def __init__(self, 
-        id, 
+    def __init__(self,
+        id,
         imdb_id,
-        original_title, 
-        english_title, 
-        poster_path, 
-        vote_average, 
-        vote_count, 
-        estimated_country, 
-        year, 
+        original_title,
+        english_title,
+        poster_path,
+        vote_average,
+        vote_count,
+        estimated_country,
+        year,
         director,
-        genres, 
-        weighted_rating, 
+        genres,
+        weighted_rating,
         overview):
         self.id = id
         self.imdb_id = imdb_id
@@ -204,10 +298,38 @@ class DiscoveryMovie:
         self.weighted_rating = weighted_rating
         self.overview = overview
 
+    @staticmethod
+    def belongs_in_discovery(doc: dict) -> bool:
+        return bool(doc.get('fetched') and doc.get('guessed_country'))
+
+    @classmethod
+    def from_movie(cls, doc: dict):
+        """From a movie with its genre references resolved, see resolve_movie_references"""
+        directors = [member.get('name') for member in (doc.get('credits') or {}).get('crew') or []
+                     if member.get('job') == "Director"]
+        return cls(id=doc['_id'],
+                   imdb_id=doc.get('imdb_id'),
+                   original_title=doc.get('original_title'),
+                   english_title=doc.get('title') or "",
+                   poster_path=doc.get('poster_path'),
+                   vote_average=doc.get('vote_average') or 0.0,
+                   vote_count=doc.get('vote_count') or 0,
+                   estimated_country=doc.get('guessed_country'),
+                   year=doc['release_date'].split('-')[0] if doc.get('release_date') else None,
+                   director=directors[0] if directors else None,
+                   genres=[genre['name'] for genre in doc.get('genres') or []],
+                   weighted_rating=doc.get('weighted_rating') or 0.0,
+                   overview=doc.get('overview'))
+
 
-class ImdbImportMovie:
-    def __init__(self, 
-        id, 
+class ImdbImportMovie(ReadModel):
+    """A movie matched from a user's imdb or letterboxd export, country_code being its guessed_country"""
+    __slots__ = ('id', 'imdb_id', 'original_title', 'release_date', 'poster_path', 'vote_average', 'vote_count',
+                 'country_code')
+    DOCUMENT_KEYS = {'id': '_id', 'country_code': 'guessed_country'}
+
+    def __init__(self,
+        id,
         imdb_id,
         original_title,
         release_date,
@@ -222,4 +344,7 @@ class ImdbImportMovie:
         self.poster_path = poster_path
         self.vote_average = vote_average
         self.vote_count = vote_count
-        self.country_code = country_code
\ No newline at end of file
+        self.country_code = country_code
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
@@ -0,0 +1,79 @@
+import fcntl
+import json
+import os
+import time
+
+
+class RateLimiter:
+    """Token bucket kept in a small lock file, so every thread and process on the host draws from the same bucket.
+
+    The refill rate adapts AIMD style: it grows additively while calls succeed quickly, and is cut
+    multiplicatively (at most once per cooldown) when the api answers 429 or responses get slow.
+    """
+
+    def __init__(self, path, rate, min_rate=1.0, max_rate=50.0, burst=10, increase=0.5, decrease=0.5,
+                 slow_latency=2.0, cooldown=1.0):
+        self.path = path
+        self.initial_rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_latency = slow_latency
+        self.cooldown = cooldown
+
+    def acquire(self):
+        """Blocks until a token is available"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self):
+        """Takes a token and returns the number of seconds the caller must wait before using it"""
+        def take(state, now):
+            state['tokens'] -= 1
+            return max(0.0, -state['tokens'] / state['rate'])
+        return self.__update(take)
+
+    def feedback(self, latency, throttled=False, retry_after=0):
+        """Adjusts the shared rate based on how the api responded"""
+        def adapt(state, now):
+            if throttled or latency > self.slow_latency:
+                if now - state['decreased'] >= self.cooldown:
+                    state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                    state['decreased'] = now
+                if retry_after:
+                    # Everyone sharing the bucket sits out the Retry-After window
+                    state['tokens'] = min(state['tokens'], -retry_after * state['rate'])
+            else:
+                state['rate'] = min(self.max_rate, state['rate'] + self.increase / state['rate'])
+            return state['rate']
+        return self.__update(adapt)
+
+    @property
+    def rate(self):
+        return self.__update(lambda state, now: state['rate'])
+
+    def __update(self, func):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            state = self.__read(fd, now)
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * state['rate'])
+            state['updated'] = now
+            result = func(state, now)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps(state).encode('utf-8'))
+            return result
+        finally:
+            os.close(fd)
+
+    def __read(self, fd, now):
+        raw = os.read(fd, 4096)
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return {'tokens': self.burst, 'updated': now, 'rate': self.initial_rate, 'decreased': 0.0}
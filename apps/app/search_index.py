@@ -0,0 +1,120 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from pymongo.errors import DuplicateKeyError
+from sentry_sdk.crons import monitor
+
+from apps.app.helper import log, chunks
+from apps.app.db_models import Movie, DeletedMovie, SearchIndexState, attach_movie_details, tz
+from apps.app.meilisearch_client import client
+from apps.app.models import SearchMovie
+
+MOVIES_INDEX = 'movies'
+
+
+def search_documents(movies: list[dict]) -> list[dict]:
+    """The meilisearch documents of raw movies projected with SearchMovie.FIELDS"""
+    attach_movie_details(movies, {'credits.crew.name': 1, 'credits.crew.job': 1})
+    return [SearchMovie.from_document(movie).to_dict() for movie in movies]
+
+
+def get_watermark():
+    state = SearchIndexState.objects(id=MOVIES_INDEX).first()
+    return state.watermark if state else None
+
+
+def save_watermark(watermark):
+    SearchIndexState.objects(id=MOVIES_INDEX).update_one(set__watermark=watermark, upsert=True)
+
+
+def lease_index(claimant, lease_seconds=None):
+    """Leases the movies index to claimant, or renews its lease, unless another run holds a live one.
+       Returns whether claimant holds it. A lease that runs out, because the run crashed or hung, can be taken over.
+    """
+    lease_seconds = lease_seconds if lease_seconds else settings.SEARCH_INDEX_LEASE_SECONDS
+    now = datetime.now(tz)
+    try:
+        SearchIndexState._get_collection().update_one(
+            {'_id': MOVIES_INDEX, '$or': [{'lease_expiry': None}, {'lease_expiry': {'$lt': now}},
+                                          {'leased_by': claimant}]},
+            {'$set': {'leased_by': claimant, 'lease_expiry': now + timedelta(seconds=lease_seconds)}},
+            upsert=True)
+        return True
+    except DuplicateKeyError:
+        # The state exists, but with someone else's live lease
+        return False
+
+
+def release_index(claimant):
+    SearchIndexState._get_collection().update_one({'_id': MOVIES_INDEX, 'leased_by': claimant},
+                                                  {'$unset': {'leased_by': '', 'lease_expiry': ''}})
+
+
+def reset_search_index():
+    """Forgets the watermark and the tombstones, for a full reindex that starts now"""
+    save_watermark(datetime.now(tz))
+    DeletedMovie.objects.all().delete()
+
+
+@monitor(monitor_slug='index_changed_movies')
+def index_changed_movies(batch_size=None):
+    """Brings the movies index up to date with what changed since the last run, instead of reindexing everything.
+       Movies deleted from mongo are removed by their tombstones first, then every fetched movie with an
+       updated_date past the watermark is pushed, in updated_date order, moving the watermark along batch by batch.
+       The watermark is looked back from by SEARCH_INDEX_OVERLAP_SECONDS, so writes still in flight during
+       the last run aren't missed. Without a watermark every fetched movie is pushed.
+       Only the run holding the lease on the index moves the watermark, runs started meanwhile return right away.
+    """
+    batch_size = batch_size if batch_size else settings.SEARCH_INDEX_BATCH_SIZE
+    layer = get_channel_layer()
+    claimant = str(uuid.uuid4())
+    if not lease_index(claimant):
+        log(layer=layer, message="Skipped indexing changed movies, another run holds the search index")
+        return 0, 0
+    try:
+        return __index_changed_movies(claimant, batch_size, layer)
+    finally:
+        release_index(claimant)
+
+
+def __index_changed_movies(claimant, batch_size, layer):
+    started = time.monotonic()
+    started_at = datetime.now(tz)
+    index = client.index(MOVIES_INDEX)
+
+    tombstones = list(DeletedMovie._get_collection().find({}, {'_id': 1, 'deleted_date': 1}))
+    if tombstones:
+        movie_ids = [tombstone['_id'] for tombstone in tombstones]
+        index.delete_documents(movie_ids)
+        # Movies deleted again while this ran keep their newer tombstone
+        DeletedMovie._get_collection().delete_many({'_id': {'$in': movie_ids},
+                                                    'deleted_date': {'$lte': max(t['deleted_date']
+                                                                                 for t in tombstones)}})
+
+    watermark = get_watermark()
+    selector = {'fetched': True}
+    if watermark:
+        selector['updated_date'] = {'$gt': watermark - timedelta(seconds=settings.SEARCH_INDEX_OVERLAP_SECONDS)}
+    movies = Movie._get_collection().find(selector, dict(SearchMovie.FIELDS, updated_date=1)).sort('updated_date', 1)
+    indexed = 0
+    for chunk in chunks(movies, batch_size):
+        batch = list(chunk)
+        index.add_documents(search_documents(batch))
+        indexed += len(batch)
+        if not lease_index(claimant):
+            log(layer=layer, message=f"Stopped indexing changed movies after {indexed}, the lease ran out and "
+                                     f"another run took over")
+            return indexed, len(tombstones)
+        if batch[-1].get('updated_date'):
+            watermark = batch[-1]['updated_date']
+            save_watermark(watermark)
+    if not watermark:
+        # Nothing stored before updated_date existed has one
+        save_watermark(started_at)
+
+    log(layer=layer, message=f"Indexed {indexed} changed movies and removed {len(tombstones)} deleted ones "
+                             f"in {time.monotonic() - started:.1f}s")
+    return indexed, len(tombstones)
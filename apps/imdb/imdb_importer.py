@@ -2,13 +2,19 @@ import csv
 import json
 import requests
 import sys
+import time
+from datetime import datetime
 
+from celery import chord
 from sentry_sdk.crons import monitor
 from channels.layers import get_channel_layer
 
-from apps.worker.celery_tasks import import_imdb_ratings_task, import_imdb_titles_task
+from apps.worker.celery_tasks import import_imdb_ratings_task, import_imdb_titles_task, \
+    recompute_weighted_ratings_task
 from apps.app.helper import chunks, __unzip_file, log
-from apps.app.db_models import Log, Movie
+from apps.app.models import ImdbImportMovie
+from apps.app.db_models import Log, Movie, RatingPrior, REFERENCE_DATA_KEY, WEIGHTED_RATING_MIN_VOTES, tz, \
+    bump_reference_data_version
 
 
 def parse_user_watched(file):
@@ -23,23 +29,10 @@ def parse_user_watched(file):
     for i in chunks(data.items(), 100):
         u = [x[0] for x in i]
         count = count + len(u)
-        matches = Movie.objects(imdb_id__in=u).only('guessed_country', 'imdb_id',
-                                                    'id', 'original_title',
-                                                    'release_date', 'poster_path',
-                                                    'vote_average', 'vote_count')
-        for match in matches:
-            if match.guessed_country:
-                country = match.guessed_country
-                result['found'].setdefault(country, []).append({
-                    'imdb_id': match.imdb_id,
-                    'id': match.id,
-                    'original_title': match.original_title,
-                    'release_date': match.release_date,
-                    'poster_path': match.poster_path,
-                    'vote_average': match.vote_average,
-                    'vote_count': match.vote_count,
-                    'country_code': country
-                })
+        matches = Movie._get_collection().find({'imdb_id': {'$in': u}}, ImdbImportMovie.projection())
+        for match in map(ImdbImportMovie.from_document, matches):
+            if match.country_code:
+                result['found'].setdefault(match.country_code, []).append(match.to_dict())
         print("Processed: %s" % count)
     return result
 
@@ -62,18 +55,53 @@ def import_imdb_ratings():
 
         reader = csv.reader(contents, delimiter='\t')
         next(reader)
+        tasks = []
         for chunk in chunks(reader, 100):
             chunk_list = list(chunk)
             ids = [x[0] for x in chunk_list]
             found_ids = [x.imdb_id for x in Movie.objects(imdb_id__in=ids).only('imdb_id')]
             data = [x for x in chunk_list if x[0] in found_ids]
             if data:
-                import_imdb_ratings_task.delay(data)
+                tasks.append(import_imdb_ratings_task.s(data))
+        if tasks:
+            # The prior is recomputed once every chunk has been written, not over a half imported catalogue
+            chord(tasks)(recompute_weighted_ratings_task.si())
         Log(type="import", message='import_imdb_ratings').save()
     else:
         log(layer=layer, message=f"Exception: {response.status_code} - {response.content}")
 
 
+@monitor(monitor_slug='recompute_weighted_ratings')
+def recompute_weighted_ratings(min_votes=WEIGHTED_RATING_MIN_VOTES):
+    """Re-ranks the whole catalogue in two server side passes, without moving a document over the network.
+       The prior mean C is the average rating of every fetched movie with votes, and is stored so that
+       movies fetched or rated later are weighted against the same prior.
+       Only movies whose weighted_rating actually changes are written.
+    """
+    layer = get_channel_layer()
+    started = time.monotonic()
+    collection = Movie._get_collection()
+    v, r = Movie.rating_expressions()
+    means = list(collection.aggregate([{'$match': {'fetched': True}},
+                                       {'$project': {'v': v, 'r': r}},
+                                       {'$match': {'v': {'$gt': 0}}},
+                                       {'$group': {'_id': None, 'mean': {'$avg': '$r'}, 'movies': {'$sum': 1}}}]))
+    if not means:
+        log(layer=layer, message="No rated movies, keeping the weighted rating prior as is")
+        return 0
+    mean = means[0]['mean']
+    RatingPrior(id=REFERENCE_DATA_KEY, min_votes=min_votes, mean=mean, updated=datetime.now(tz)).save()
+    bump_reference_data_version()
+
+    weighted_rating = Movie.weighted_rating_expression(min_votes, mean)
+    result = collection.update_many({'fetched': True, '$expr': {'$ne': ['$weighted_rating', weighted_rating]}},
+                                    [{'$set': {'weighted_rating': weighted_rating, 'updated_date': '$$NOW'}}])
+    log(layer=layer, message=f"Recomputed weighted ratings with m={min_votes} and C={mean:.3f} from "
+                             f"{means[0]['movies']} rated movies, {result.modified_count} changed "
+                             f"in {time.monotonic() - started:.1f}s")
+    return result.modified_count
+
+
 @monitor(monitor_slug='import_imdb_alt_titles')
 def import_imdb_alt_titles():
     """titleId ordering title region language types attributes isOriginalTitle
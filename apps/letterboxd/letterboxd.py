@@ -1,6 +1,6 @@
 import csv
 from apps.app.meilisearch_client import client
-from apps.app.models import Movie
+from apps.app.models import Movie, ImdbImportMovie
 
 def parse_user_watched(file):
     index = client.index("movies")
@@ -81,31 +81,18 @@ def parse_user_watched(file):
 
     # Prefer querying by pk if we have IDs, otherwise try imdb_id
     if found_ids:
-        matches = Movie.objects(pk__in=found_ids).only(
-            'guessed_country', 'imdb_id', 'id', 'original_title',
-            'release_date', 'poster_path', 'vote_average', 'vote_count'
-        )
+        matches = Movie._get_collection().find({'_id': {'$in': found_ids}}, ImdbImportMovie.projection())
     elif found_imdb_ids:
-        matches = Movie.objects(imdb_id__in=found_imdb_ids).only(
-            'guessed_country', 'imdb_id', 'id', 'original_title',
-            'release_date', 'poster_path', 'vote_average', 'vote_count'
-        )
+        matches = Movie._get_collection().find({'imdb_id': {'$in': found_imdb_ids}}, ImdbImportMovie.projection())
     else:
         matches = []
 
     # Build 'found' structure grouped by guessed_country
-    for match in matches:
-        country = match.guessed_country or "unknown"
-        result['found'].setdefault(country, []).append({
-            'imdb_id': match.imdb_id,
-            'id': str(match.id),
-            'original_title': match.original_title,
-            'release_date': match.release_date,
-            'poster_path': match.poster_path,
-            'vote_average': match.vote_average,
-            'vote_count': match.vote_count,
-            'country_code': country
-        })
+    for match in map(ImdbImportMovie.from_document, matches):
+        country = match.country_code or "unknown"
+        match.country_code = country
+        match.id = str(match.id)
+        result['found'].setdefault(country, []).append(match.to_dict())
 
     # If we collected ids but matches is empty, log that — likely id mismatch between Meili and Mongo
     #if (found_ids or found_imdb_ids) and not matches:
@@ -0,0 +1,163 @@
+import atexit
+import concurrent.futures
+import functools
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import socket
+import threading
+from datetime import datetime
+
+import django
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+from apps.app.bulk_writer import MovieWriter
+from apps.app.helper import log, get_statics, chunks
+from apps.app.db_models import Movie, get_reference_data
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+DUPLICATE_KEY = 11000
+
+
+class ResponseArchive:
+    """Append-only archive of raw TMDB movie responses, one json record per line keyed by id and fetch date.
+
+    Records are buffered and appended as complete gzip members, so a segment stays readable even if the
+    process dies mid-run. Every process writes its own segments, and rolls over to a new one at segment_bytes.
+    """
+
+    def __init__(self, directory, segment_bytes, batch_size=500):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.__lines = []
+        self.__lock = threading.Lock()
+        self.__segment = None
+        self.__sequence = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, movie_id, fetched_date, data):
+        record = json.dumps({'id': movie_id, 'fetched_date': fetched_date.isoformat(), 'data': data})
+        with self.__lock:
+            self.__lines.append(record)
+            if len(self.__lines) >= self.batch_size:
+                self.__flush()
+
+    def flush(self):
+        with self.__lock:
+            self.__flush()
+
+    def __flush(self):
+        if not self.__lines:
+            return
+        member = gzip.compress(('\n'.join(self.__lines) + '\n').encode('utf-8'))
+        self.__lines = []
+        if self.__segment is None or os.path.getsize(self.__segment) >= self.segment_bytes:
+            self.__segment = self.__new_segment()
+        with open(self.__segment, 'ab') as segment:
+            segment.write(member)
+
+    def __new_segment(self):
+        self.__sequence += 1
+        name = (f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{socket.gethostname()}-{os.getpid()}-"
+                f"{self.__sequence:04d}{SEGMENT_SUFFIX}")
+        return os.path.join(self.directory, name)
+
+
+__archive = None
+__archive_lock = threading.Lock()
+
+
+def get_archive():
+    """The process wide archive, or None when TMDB_ARCHIVE_DIR isn't configured"""
+    global __archive
+    if not settings.TMDB_ARCHIVE_DIR:
+        return None
+    with __archive_lock:
+        if __archive is None or __archive.directory != settings.TMDB_ARCHIVE_DIR:
+            if __archive is not None:
+                __archive.flush()
+            __archive = ResponseArchive(settings.TMDB_ARCHIVE_DIR, settings.TMDB_ARCHIVE_SEGMENT_BYTES)
+            atexit.register(__archive.flush)
+        return __archive
+
+
+def store(movie_id, fetched_date, data):
+    archive = get_archive()
+    if archive:
+        archive.append(movie_id, fetched_date, data)
+
+
+def flush():
+    archive = get_archive()
+    if archive:
+        archive.flush()
+
+
+def segments(directory=None):
+    directory = directory if directory else settings.TMDB_ARCHIVE_DIR
+    return sorted(glob.glob(os.path.join(directory, f"*{SEGMENT_SUFFIX}")))
+
+
+def read_segment(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as segment:
+        for line in segment:
+            if line.strip():
+                yield json.loads(line)
+
+
+def replay_segment(path, storage_profile=None):
+    """Re-runs add_fetched_info over every record in a segment, and bulk writes the result.
+       A record only replaces a movie whose stored fetch is not newer, so segments can be replayed in any order.
+       Movies missing from mongo get a stub first, so a segment can also be replayed into an empty database.
+       Records are stored as archived, so replaying with a larger storage_profile re-expands trimmed movies.
+    """
+    storage_profile = storage_profile if storage_profile else settings.TMDB_STORAGE_PROFILE
+    all_genres, all_langs, all_countries = get_statics()
+    rating_prior = get_reference_data().rating_prior
+    with MovieWriter(f"Replay {os.path.basename(path)}",
+                     batch_size=settings.TMDB_WRITE_BATCH_SIZE,
+                     flush_interval=settings.TMDB_WRITE_FLUSH_INTERVAL,
+                     split_details=settings.TMDB_SPLIT_MOVIE_DETAILS) as writer:
+        for chunk in chunks(read_segment(path), settings.TMDB_WRITE_BATCH_SIZE):
+            records = list(chunk)
+            __insert_missing([record['id'] for record in records])
+            for record in records:
+                fetched_date = datetime.fromisoformat(record['fetched_date'])
+                movie = Movie(id=record['id'])
+                movie.add_fetched_info(record['data'], all_genres, all_langs, all_countries, storage_profile)
+                movie.fetched_date = fetched_date
+                # A plain upsert would collide with the _id of a newer stored fetch, hence the stubs
+                writer.add_movie(movie, {'_id': movie.id, '$or': [{'fetched_date': {'$lte': fetched_date}},
+                                                                  {'fetched_date': None}]}, rating_prior)
+    return writer.written
+
+
+def __insert_missing(movie_ids):
+    """Inserts unfetched stubs for the ids that aren't stored, skipping the ones that are"""
+    template = Movie(fetched=False).to_mongo().to_dict()
+    try:
+        Movie._get_collection().insert_many([dict(template, _id=movie_id) for movie_id in movie_ids], ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+
+
+def replay_archive(workers=None, storage_profile=None):
+    """Reprocesses the whole archive in parallel, one segment per process"""
+    paths = segments()
+    workers = workers if workers else settings.TMDB_REPLAY_WORKERS
+    storage_profile = storage_profile if storage_profile else settings.TMDB_STORAGE_PROFILE
+    log(f"Replaying {len(paths)} archive segments with {workers} processes, storing {storage_profile} movies")
+    # Spawned processes set up django, and with it their own mongo connection
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=django.setup) as executor:
+        total = 0
+        for path, written in zip(paths, executor.map(functools.partial(replay_segment,
+                                                                       storage_profile=storage_profile), paths)):
+            total += written
+            log(f"Replayed {written} movies from {os.path.basename(path)}, {total} in total")
+    log(f"Done replaying archive, {total} movies reprocessed")
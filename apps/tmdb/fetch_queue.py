@@ -0,0 +1,192 @@
+import concurrent.futures
+import math
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from apps.app.bulk_writer import MovieWriter
+from apps.app.helper import log, chunks
+from apps.app.db_models import Movie, FetchDeadLetter, tz, get_reference_data
+from apps.tmdb import archive
+from apps.tmdb.tmdb_client import fetch_movie, RetryScheduler, UnauthorizedError
+
+DEAD_LETTER = 'dead-letter'
+PARKED = datetime(9999, 1, 1)
+
+# Weights of the fetch priority, see priority_score
+PRIORITY_POPULARITY_WEIGHT = 1.0
+PRIORITY_RATING_WEIGHT = 0.5
+PRIORITY_NEW_BONUS = 2.0
+PRIORITY_CHANGED_BONUS = 1.0
+PRIORITY_STALENESS_WEIGHT = 2.0
+PRIORITY_STALENESS_DAYS = 365
+
+
+def worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def __available(now):
+    """Unfetched movies nobody holds a live lease on"""
+    return {'fetched': False, '$or': [{'lease_expiry': None}, {'lease_expiry': {'$lt': now}}]}
+
+
+def priority_score(popularity=0, weighted_rating=0, is_new=False, is_changed=False, fetched_date=None):
+    """Higher goes first. Popular and well rated movies, new or changed ones, and those not fetched for a
+       long time are fetched before the long tail. Never fetched counts as maximally stale.
+    """
+    if fetched_date is None:
+        staleness = PRIORITY_STALENESS_DAYS
+    else:
+        if fetched_date.tzinfo is None:
+            fetched_date = tz.localize(fetched_date)
+        staleness = min(PRIORITY_STALENESS_DAYS, (datetime.now(tz) - fetched_date).days)
+    return (math.log1p(max(popularity or 0, 0)) * PRIORITY_POPULARITY_WEIGHT
+            + (weighted_rating or 0) * PRIORITY_RATING_WEIGHT
+            + (PRIORITY_NEW_BONUS if is_new else 0)
+            + (PRIORITY_CHANGED_BONUS if is_changed else 0)
+            + staleness / PRIORITY_STALENESS_DAYS * PRIORITY_STALENESS_WEIGHT)
+
+
+def priority_expression(is_new=False, is_changed=False):
+    """priority_score as an aggregation expression over the stored movie, for update pipelines"""
+    staleness = {'$min': [PRIORITY_STALENESS_DAYS,
+                          {'$ifNull': [{'$dateDiff': {'startDate': '$fetched_date', 'endDate': '$$NOW',
+                                                      'unit': 'day'}},
+                                       PRIORITY_STALENESS_DAYS]}]}
+    return {'$add': [
+        {'$multiply': [{'$ln': {'$add': [1, {'$max': [0, {'$ifNull': ['$popularity', 0]}]}]}},
+                       PRIORITY_POPULARITY_WEIGHT]},
+        {'$multiply': [{'$ifNull': ['$weighted_rating', 0]}, PRIORITY_RATING_WEIGHT]},
+        PRIORITY_NEW_BONUS if is_new else 0,
+        PRIORITY_CHANGED_BONUS if is_changed else 0,
+        {'$multiply': [{'$divide': [staleness, PRIORITY_STALENESS_DAYS]}, PRIORITY_STALENESS_WEIGHT]}]}
+
+
+def count_available():
+    return Movie._get_collection().count_documents(__available(datetime.now(tz)))
+
+
+def claim_movies(claimant, limit, lease_seconds=None):
+    """Atomically leases the up to limit highest priority unfetched movies to claimant, and returns the ids it got.
+       A lease that runs out, because the worker crashed or hung, makes the movie available again.
+    """
+    lease_seconds = lease_seconds if lease_seconds else settings.TMDB_CLAIM_LEASE_SECONDS
+    collection = Movie._get_collection()
+    now = datetime.now(tz)
+    candidates = [doc['_id'] for doc in collection.find(__available(now), {'_id': 1})
+                  .sort('fetch_priority', -1).limit(limit)]
+    if not candidates:
+        return []
+    # The availability check is re-evaluated per document, so racing claimants never get the same movie
+    token = f"{claimant}:{uuid.uuid4().hex}"
+    collection.update_many(dict(__available(now), _id={'$in': candidates}),
+                           {'$set': {'claimed_by': token,
+                                     'lease_expiry': now + timedelta(seconds=lease_seconds)}})
+    return [doc['_id'] for doc in collection.find({'_id': {'$in': candidates}, 'claimed_by': token}, {'_id': 1})]
+
+
+def iter_claimed_ids(claimant, batch_size=None):
+    """Yields movie ids, leasing a new batch whenever the previous one has been handed out"""
+    batch_size = batch_size if batch_size else settings.TMDB_CLAIM_BATCH_SIZE
+    while True:
+        claimed = claim_movies(claimant, batch_size)
+        if not claimed:
+            return
+        yield from claimed
+
+
+def movie_writer():
+    return MovieWriter("Movie writes",
+                       batch_size=settings.TMDB_WRITE_BATCH_SIZE,
+                       flush_interval=settings.TMDB_WRITE_FLUSH_INTERVAL,
+                       split_details=settings.TMDB_SPLIT_MOVIE_DETAILS)
+
+
+def persist_fetched_movie(data, writer, all_genres, all_langs, all_countries):
+    """Queues the fetched movie for writing, which also drops its lease, and archives the raw response"""
+    movie = Movie(id=data['id'])
+    movie.add_fetched_info(dict(data), all_genres, all_langs, all_countries, settings.TMDB_STORAGE_PROFILE)
+    archive.store(movie.id, movie.fetched_date, data)
+    writer.add_movie(movie, {'_id': movie.id}, get_reference_data().rating_prior, upsert=True)
+
+
+def fetch_and_persist(movie_ids, writer, statics, threads=None, window=None):
+    """Fetches movie_ids on a thread pool with at most window fetches in flight.
+       Ids are pulled lazily, and nothing new is submitted while the writer is flushing,
+       so memory stays constant however many movies are pending.
+       Failed fetches are re-queued with backoff instead of sleeping in a worker, and dead lettered
+       once they run out of attempts.
+    """
+    threads = threads if threads else settings.TMDB_FETCH_THREADS
+    window = window if window else settings.TMDB_FETCH_WINDOW
+    movie_ids = iter(movie_ids)
+    retries = RetryScheduler()
+    in_flight = dict()
+    exhausted = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            while len(in_flight) < window:
+                next_up = retries.pop_ready()
+                if next_up is None and not exhausted:
+                    movie_id = next(movie_ids, None)
+                    exhausted = movie_id is None
+                    next_up = (movie_id, 1) if movie_id is not None else None
+                if next_up is None:
+                    break
+                in_flight[executor.submit(fetch_movie, next_up[0])] = next_up
+            if not in_flight:
+                if not retries:
+                    return
+                time.sleep(retries.seconds_until_next())
+                continue
+            done, _ = concurrent.futures.wait(in_flight, timeout=retries.seconds_until_next(),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                movie_id, attempt = in_flight.pop(future)
+                __persist_result(future, movie_id, attempt, retries, writer, statics)
+
+
+def __persist_result(future, movie_id, attempt, retries, writer, statics):
+    try:
+        data = future.result()
+    except UnauthorizedError:
+        raise
+    except Exception as exc:
+        if not retries.retry_or_give_up(movie_id, attempt, exc):
+            dead_letter(movie_id, attempt, exc)
+        return
+    try:
+        if data is not None:
+            persist_fetched_movie(data, writer, *statics)
+    except Exception as exc:
+        log(message=f"Could not process data: {exc}", e=exc)
+
+
+def dead_letter(movie_id, attempts, error):
+    """Records a movie that ran out of attempts, and parks it on a lease that never expires
+       so later runs skip it until it's re-driven.
+    """
+    now = datetime.now(tz)
+    FetchDeadLetter._get_collection().update_one({'_id': movie_id},
+                                                 {'$set': {'attempts': attempts,
+                                                           'error': str(error),
+                                                           'failed_at': now}},
+                                                 upsert=True)
+    Movie._get_collection().update_one({'_id': movie_id},
+                                       {'$set': {'claimed_by': DEAD_LETTER, 'lease_expiry': PARKED}})
+    log(f"Gave up on id: {movie_id} after {attempts} attempts: {error}")
+
+
+def redrive_dead_letters():
+    """Releases every dead lettered movie back into the fetch queue"""
+    movie_ids = list(FetchDeadLetter.objects.scalar('id'))
+    for chunk in chunks(movie_ids, 1000):
+        batch = list(chunk)
+        Movie._get_collection().update_many({'_id': {'$in': batch}, 'claimed_by': DEAD_LETTER},
+                                            {'$unset': {'claimed_by': '', 'lease_expiry': ''}})
+        FetchDeadLetter._get_collection().delete_many({'_id': {'$in': batch}})
+    log(f"Re-drove {len(movie_ids)} dead lettered movies")
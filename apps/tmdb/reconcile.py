@@ -0,0 +1,163 @@
+import time
+from array import array
+from itertools import islice, repeat
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+from apps.app.helper import chunks, log
+from apps.app.db_models import Movie, DiscoveryMovie, MovieDetails, record_deleted_movies
+from apps.tmdb.fetch_queue import priority_score, priority_expression
+
+DUPLICATE_KEY = 11000
+
+
+def sorted_id_array(movie_ids):
+    """Packs ids into a compact int64 array, sorted ascending.
+       The daily export is usually already ordered, in which case no extra copy is made.
+    """
+    ids = array('q', movie_ids)
+    if not __is_sorted(ids):
+        ids = array('q', sorted(ids))
+    return ids
+
+
+def sorted_export_arrays(rows):
+    """Packs (id, popularity) rows into parallel int64/float64 arrays, sorted by id"""
+    ids, popularity = array('q'), array('d')
+    for movie_id, movie_popularity in rows:
+        ids.append(movie_id)
+        popularity.append(movie_popularity)
+    if not __is_sorted(ids):
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        ids = array('q', (ids[i] for i in order))
+        popularity = array('d', (popularity[i] for i in order))
+    return ids, popularity
+
+
+def __is_sorted(ids):
+    return all(a <= b for a, b in zip(ids, islice(ids, 1, None)))
+
+
+def load_existing_ids():
+    """Streams every movie id once, with a single projection-only cursor in _id order.
+       Returns (all_ids, unfetched_ids) as sorted int64 arrays.
+    """
+    all_ids, unfetched_ids = array('q'), array('q')
+    for doc in Movie._get_collection().find({}, {'_id': 1, 'fetched': 1}).sort('_id', 1).batch_size(10000):
+        all_ids.append(doc['_id'])
+        if doc.get('fetched') is False:
+            unfetched_ids.append(doc['_id'])
+    return all_ids, unfetched_ids
+
+
+def sorted_difference(left, right):
+    """Yields the ids of the sorted sequence left which are not present in the sorted sequence right"""
+    return (left[position] for position in sorted_difference_positions(left, right))
+
+
+def sorted_difference_positions(left, right):
+    """Same as sorted_difference, but yields the positions in left instead of the ids"""
+    right = iter(right)
+    current = next(right, None)
+    previous = None
+    for position, movie_id in enumerate(left):
+        if movie_id == previous:
+            continue
+        previous = movie_id
+        while current is not None and current < movie_id:
+            current = next(right, None)
+        if current != movie_id:
+            yield position
+
+
+def insert_movie_stubs(movie_ids, priorities, batch_size=None, layer=None):
+    """Inserts Movie(id, fetched=False) stubs with large unordered bulk inserts, priorities being their
+       fetch_priority in the same order. Duplicates are skipped instead of aborting the rest of the batch.
+    """
+    batch_size = batch_size if batch_size else settings.TMDB_RECONCILE_BATCH_SIZE
+    layer = layer if layer else get_channel_layer()
+    template = Movie(fetched=False).to_mongo().to_dict()
+    collection = Movie._get_collection()
+    inserted = 0
+    for chunk in chunks(zip(movie_ids, priorities), batch_size):
+        documents = [dict(template, _id=movie_id, fetch_priority=priority) for movie_id, priority in chunk]
+        try:
+            inserted += len(collection.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            inserted += e.details['nInserted']
+            if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+                raise
+        log(layer=layer, message=f"Persisted {inserted} new movies")
+    return inserted
+
+
+def purge_movies(movie_ids, batch_size=None, layer=None):
+    """Deletes the movies still unfetched, and their DiscoveryMovie and MovieDetails rows, in large _id $in batches.
+       Tombstones are left for the search index, which a full reindex may have added stubs to.
+    """
+    batch_size = batch_size if batch_size else settings.TMDB_RECONCILE_BATCH_SIZE
+    layer = layer if layer else get_channel_layer()
+    movies = Movie._get_collection()
+    discovery_movies = DiscoveryMovie._get_collection()
+    movie_details = MovieDetails._get_collection()
+    total = len(movie_ids)
+    deleted = 0
+    for chunk in chunks(movie_ids, batch_size):
+        # Movies fetched since the ids were read are kept, along with their discovery and details rows
+        batch = [doc['_id'] for doc in movies.find({'_id': {'$in': list(chunk)}, 'fetched': False}, {'_id': 1})]
+        if not batch:
+            continue
+        deleted += movies.delete_many({'_id': {'$in': batch}, 'fetched': False}).deleted_count
+        discovery_movies.delete_many({'_id': {'$in': batch}})
+        movie_details.delete_many({'_id': {'$in': batch}})
+        record_deleted_movies(batch)
+        log(layer=layer, message=f"Deleted {deleted} movies out of {total}")
+    return deleted
+
+
+def reconcile_export(rows, layer=None):
+    """Reconciles the (id, popularity) rows of the daily export against the Movie collection.
+       New ids are inserted as unfetched stubs, and the unfetched ids no longer in the export are returned.
+    """
+    layer = layer if layer else get_channel_layer()
+    started = time.monotonic()
+    export_ids, popularity = sorted_export_arrays(rows)
+    all_ids, unfetched_ids = load_existing_ids()
+    new_positions = array('q', sorted_difference_positions(export_ids, all_ids))
+    stale_ids = array('q', sorted_difference(unfetched_ids, export_ids))
+    log(layer=layer, message=f"Reconciled {len(export_ids)} exported ids against {len(all_ids)} movies in "
+                             f"{time.monotonic() - started:.1f}s: {len(new_positions)} new, {len(stale_ids)} stale")
+
+    new_ids = (export_ids[position] for position in new_positions)
+    priorities = (priority_score(popularity=popularity[position], is_new=True) for position in new_positions)
+    inserted = insert_movie_stubs(new_ids, priorities, layer=layer)
+    log(layer=layer, message=f"Persisted {inserted} movies out of {len(new_positions)} "
+                             f"in {time.monotonic() - started:.1f}s")
+    return stale_ids
+
+
+def reschedule_changed_movies(movie_ids, end_date, layer=None):
+    """Marks changed movies fetched before end_date for a refetch with one update_many per batch,
+       and inserts the changed ids we've never seen as unfetched stubs.
+    """
+    layer = layer if layer else get_channel_layer()
+    collection = Movie._get_collection()
+    changed_ids = sorted_id_array(movie_ids)
+    rescheduled = 0
+    new_ids = array('q')
+    for chunk in chunks(changed_ids, settings.TMDB_RECONCILE_BATCH_SIZE):
+        batch = list(chunk)
+        rescheduled += collection.update_many({'_id': {'$in': batch},
+                                               'fetched': True,
+                                               'fetched_date': {'$lt': end_date}},
+                                              [{'$set': {'fetched': False,
+                                                         'fetch_priority': priority_expression(is_changed=True)}}]
+                                              ).modified_count
+        known_ids = sorted_id_array(doc['_id'] for doc in collection.find({'_id': {'$in': batch}}, {'_id': 1}))
+        new_ids.extend(sorted_difference(batch, known_ids))
+    new_priority = priority_score(is_new=True, is_changed=True)
+    inserted = insert_movie_stubs(new_ids, repeat(new_priority), layer=layer)
+    log(layer=layer, message=f"Scheduled {rescheduled} changed movies for update, and added {inserted} new movies")
+    return rescheduled, inserted
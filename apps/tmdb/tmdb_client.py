@@ -0,0 +1,295 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from apps.app.helper import log
+from apps.app.db_models import Movie, MovieDetails, DiscoveryMovie, record_deleted_movies
+from apps.app.rate_limiter import RateLimiter
+
+API_URL = "https://api.themoviedb.org/3"
+
+__session = None
+__session_lock = threading.Lock()
+__rate_limiter = None
+
+
+def movie_url(movie_id):
+    api_key = os.getenv('TMDB_API', 'test')
+    return (f"{API_URL}/movie/{movie_id}?api_key={api_key}&language=en-US"
+            f"&append_to_response=alternative_titles,credits,external_ids,images,account_states,"
+            f"recommendations,watch/providers")
+
+
+def get_session() -> requests.Session:
+    """One keep-alive session per process, shared by every thread calling TMDB"""
+    global __session
+    with __session_lock:
+        if __session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4,
+                                  pool_maxsize=settings.TMDB_FETCH_THREADS,
+                                  max_retries=Retry(connect=3, backoff_factor=2))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            __session = session
+        return __session
+
+
+def get_rate_limiter() -> RateLimiter:
+    """The limiter every TMDB api call goes through, shared with all processes on this host"""
+    global __rate_limiter
+    with __session_lock:
+        if __rate_limiter is None:
+            __rate_limiter = RateLimiter(settings.TMDB_RATE_LIMIT_FILE,
+                                         rate=settings.TMDB_RATE_LIMIT,
+                                         min_rate=settings.TMDB_RATE_LIMIT_MIN,
+                                         max_rate=settings.TMDB_RATE_LIMIT_MAX,
+                                         burst=settings.TMDB_RATE_LIMIT_BURST)
+        return __rate_limiter
+
+
+def get(url, timeout=10, **kwargs) -> requests.Response:
+    """Rate limited GET against TMDB over the shared session"""
+    limiter = get_rate_limiter()
+    limiter.acquire()
+    started = time.monotonic()
+    try:
+        response = get_session().get(url, timeout=timeout, **kwargs)
+    except requests.exceptions.Timeout:
+        limiter.feedback(latency=timeout)
+        raise
+    __feedback(limiter, response.status_code, response.headers, time.monotonic() - started)
+    return response
+
+
+def __feedback(limiter, status, headers, latency):
+    throttled = status == 429 or status == 25
+    retry_after = parse_retry_after(headers.get('Retry-After')) if throttled else 0
+    limiter.feedback(latency=latency, throttled=throttled, retry_after=retry_after)
+
+
+def parse_retry_after(value, default=1):
+    """Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date.
+       Missing or unparseable values give default, and dates in the past give 0.
+    """
+    if value is None:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0, math.ceil((retry_at - datetime.now(timezone.utc)).total_seconds()))
+
+
+class RetryableFetchError(Exception):
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UnauthorizedError(Exception):
+    pass
+
+
+def retry_delay(attempt, retry_after=0):
+    """Exponential backoff with full jitter, never shorter than what the failure asked for"""
+    ceiling = min(settings.TMDB_RETRY_MAX_SECONDS, settings.TMDB_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+    return max(retry_after, random.uniform(0, ceiling))
+
+
+class RetryScheduler:
+    """Ids waiting for another attempt, ordered by when they are due.
+       Nothing sleeps per id, the fetch loop just asks for whatever is ready.
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def schedule(self, movie_id, attempt, delay):
+        heapq.heappush(self.__heap, (time.monotonic() + delay, next(self.__sequence), movie_id, attempt))
+
+    def pop_ready(self):
+        """Returns (movie_id, attempt) for the next due retry, or None"""
+        if self.__heap and self.__heap[0][0] <= time.monotonic():
+            _, _, movie_id, attempt = heapq.heappop(self.__heap)
+            return movie_id, attempt
+        return None
+
+    def seconds_until_next(self):
+        if not self.__heap:
+            return None
+        return max(0.0, self.__heap[0][0] - time.monotonic())
+
+    def retry(self, movie_id, attempt, error):
+        """Schedules another attempt and returns its delay, or None when the id is out of attempts"""
+        if attempt >= settings.TMDB_RETRY_MAX_ATTEMPTS:
+            return None
+        delay = retry_delay(attempt, getattr(error, 'retry_after', 0))
+        self.schedule(movie_id, attempt + 1, delay)
+        return delay
+
+    def retry_or_give_up(self, movie_id, attempt, error):
+        """Schedules another attempt, returns False when the id is out of attempts"""
+        delay = self.retry(movie_id, attempt, error)
+        if delay is None:
+            return False
+        log(f"Attempt {attempt} on id: {movie_id} failed, retrying in {delay:.0f}s: {error}")
+        return True
+
+
+def delete_movie(movie_id):
+    """Deletes a movie gone from tmdb, along with its movie_details and discoverymovie rows,
+       and leaves a tombstone for the search index
+    """
+    Movie.objects.filter(pk=movie_id).delete()
+    MovieDetails.objects.filter(pk=movie_id).delete()
+    DiscoveryMovie.objects.filter(pk=movie_id).delete()
+    record_deleted_movies([movie_id])
+
+
+def fetch_movie(movie_id):
+    """Makes one attempt at fetching a movie, and returns its data, or None if TMDB doesn't have it anymore.
+       Raises RetryableFetchError for failures worth another attempt, and UnauthorizedError on a rejected api key.
+    """
+    url = movie_url(movie_id)
+    log(f"Calling url: {url}")
+    try:
+        response = get(url, timeout=10)
+    except requests.exceptions.Timeout as exc:
+        raise RetryableFetchError(f"Timed out on id: {movie_id}: {exc}", retry_after=10) from exc
+    except requests.exceptions.ConnectionError as exc:
+        raise RetryableFetchError(f"ConnectionError: {exc} on url: {url}", retry_after=30) from exc
+    if response.status_code == 200:
+        return response.json()
+    elif response.status_code == 429 or response.status_code == 25:
+        # The shared rate limiter already holds back every caller until Retry-After has passed
+        raise RetryableFetchError(f"Throttled on id: {movie_id}")
+    elif response.status_code == 404:
+        delete_movie(movie_id)
+        log(f"Deleting movie with id: {movie_id} as it's not in tmdb anymore")
+        return None
+    elif response.status_code == 401:
+        log(f"Unauthorized API key when calling url: {url}")
+        raise UnauthorizedError(f"Unauthorized API key when calling url: {url}")
+    else:
+        log(f"What is going on?: id:{movie_id}, status:{response.status_code}, response: {response.content}")
+        raise RetryableFetchError("Response: %s, Content: %s" % (response.status_code, response.content))
+
+
+def fetch_movies_async(movie_ids, handle, on_failure, concurrency=None):
+    """Fetches every movie in movie_ids with asyncio over one pooled keep-alive connector,
+       calling handle(data) in a worker thread for each successfully fetched movie,
+       and on_failure(movie_id, attempts, error) for the ones that ran out of attempts.
+    """
+    concurrency = concurrency if concurrency else settings.TMDB_ASYNC_FETCH_CONCURRENCY
+    return asyncio.run(__fetch_all(iter(movie_ids), handle, on_failure, concurrency))
+
+
+async def __fetch_all(movie_ids, handle, on_failure, concurrency):
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=60, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=10)
+    retries = RetryScheduler()
+    next_lock = asyncio.Lock()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # Each worker pulls the next id off the shared iterator, which bounds the number of requests in flight
+        workers = [asyncio.create_task(__worker(session, movie_ids, next_lock, retries, handle, on_failure))
+                   for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+
+async def __worker(session, movie_ids, next_lock, retries, handle, on_failure):
+    # Anything touching mongo, the channel layer or the rate limiter's file lock blocks,
+    # so it runs in a thread instead of on the event loop
+    while True:
+        next_up = retries.pop_ready()
+        if next_up is None:
+            # Advancing the iterator may claim a batch of ids, and a generator can't be advanced by two threads
+            async with next_lock:
+                movie_id = await asyncio.to_thread(next, movie_ids, None)
+            if movie_id is None:
+                if not retries:
+                    return
+                await asyncio.sleep(retries.seconds_until_next())
+                continue
+            next_up = (movie_id, 1)
+        movie_id, attempt = next_up
+        try:
+            data = await __fetch_movie(session, movie_id)
+        except UnauthorizedError:
+            raise
+        except Exception as exc:
+            delay = retries.retry(movie_id, attempt, exc)
+            if delay is None:
+                await asyncio.to_thread(on_failure, movie_id, attempt, exc)
+            else:
+                await asyncio.to_thread(log, f"Attempt {attempt} on id: {movie_id} failed, "
+                                             f"retrying in {delay:.0f}s: {exc}")
+            continue
+        if data is not None:
+            await asyncio.to_thread(__handle, handle, data)
+
+
+def __handle(handle, data):
+    try:
+        handle(data)
+    except Exception as exc:
+        log(message=f"Could not process data: {exc}", e=exc)
+
+
+async def __fetch_movie(session, movie_id):
+    url = movie_url(movie_id)
+    limiter = get_rate_limiter()
+    await asyncio.sleep(await asyncio.to_thread(limiter.reserve))
+    started = time.monotonic()
+    try:
+        async with session.get(url) as response:
+            await asyncio.to_thread(__feedback, limiter, response.status, response.headers,
+                                    time.monotonic() - started)
+            if response.status == 200:
+                return await response.json()
+            elif response.status == 429 or response.status == 25:
+                raise RetryableFetchError(f"Throttled on id: {movie_id}")
+            elif response.status == 404:
+                await asyncio.to_thread(delete_movie, movie_id)
+                await asyncio.to_thread(log, f"Deleting movie with id: {movie_id} as it's not in tmdb anymore")
+                return None
+            elif response.status == 401:
+                await asyncio.to_thread(log, f"Unauthorized API key when calling url: {url}")
+                raise UnauthorizedError(f"Unauthorized API key when calling url: {url}")
+            else:
+                content = await response.text()
+                await asyncio.to_thread(log, f"What is going on?: id:{movie_id}, status:{response.status}, "
+                                             f"response: {content}")
+                raise RetryableFetchError(f"Response: {response.status}, Content: {content}")
+    except asyncio.TimeoutError as exc:
+        await asyncio.to_thread(limiter.feedback, latency=10)
+        raise RetryableFetchError(f"Timed out on id: {movie_id}: {exc}", retry_after=10) from exc
+    except aiohttp.ClientConnectionError as exc:
+        raise RetryableFetchError(f"ConnectionError: {exc} on url: {url}", retry_after=30) from exc
@@ -3,19 +3,22 @@ import datetime
 import json
 import os
 import requests
-import time
 from channels.layers import get_channel_layer
 from django.db import transaction
 from itertools import chain, islice
-from mongoengine import DoesNotExist
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from django.conf import settings
 from sentry_sdk.crons import monitor
 
-from apps.worker.celery_tasks import populate_discovery_movie_task
+from apps.worker.celery_tasks import populate_discovery_movie_task, merge_discovery_movies_task, fetch_tmdb_batch_task
+from apps.tmdb.reconcile import reconcile_export, purge_movies, reschedule_changed_movies
+from apps.tmdb import tmdb_client, fetch_queue, archive
+from apps.tmdb.tmdb_client import fetch_movies_async
 
-from apps.app.helper import __send_data_to_channel, __log_progress, __unzip_file, log, get_statics
-from apps.app.db_models import Movie, SpokenLanguage, Genre, ProductionCountries, WatchProvider
+from apps.app.discovery import id_ranges, rebuild_discovery_shadow
+from apps.app.helper import __send_data_to_channel, __log_progress, __log_throughput, __stream_gzip_lines, log, \
+    get_statics
+from apps.app.db_models import Movie, SpokenLanguage, Genre, ProductionCountries, WatchProvider, \
+    bump_reference_data_version
 
 
 @monitor(monitor_slug='base_import')
@@ -32,137 +35,81 @@ def download_files():
     yesterday = datetime.date.today() - datetime.timedelta(days=1)
     yesterday_formatted = yesterday.strftime("%m_%d_%Y")
     daily_export_url = "http://files.tmdb.org/p/exports/movie_ids_%s.json.gz" % yesterday_formatted
-    response = requests.get(daily_export_url, timeout=120)
 
     layer = get_channel_layer()
-    if response.status_code == 200:
-        print("Downloading file")
-        with open('movies.json.gz', 'wb') as f:
-            f.write(response.content)
-        log(layer=layer, message=f"Downloaded {daily_export_url}")
-
-        movies_to_add = []
-        tmdb_movie_ids = set()
-        contents = __unzip_file('movies.json.gz')
-        count = 0
-        for b in chunks(contents, 100):
-            chunk = []
-            u = list(b)
-            for i in u:
-                try:
-                    data = json.loads(i)
-                    if data['video'] is False and data['adult'] is False:
-                        movie_id = data['id']
-                        tmdb_movie_ids.add(movie_id)
-                        chunk.append(movie_id)
-                except Exception as e:
-                    log(layer, f"This line fucked up: {i}, because of {e}", e)
-                    print("This line fucked up: %s, because of %s" % (i, e))
-            matches = []
-            for x in Movie.objects.filter(pk__in=chunk).values_list('id'):
-                matches.append(x)
-            new_movies = (set(chunk).difference(matches))
-            for c in new_movies:
-                movies_to_add.append(Movie(id=c, fetched=False))
-            count += len(u)
-            log(layer=layer, message=f"Parsed {count} out of {len(contents)} movies from downloaded file")
-
-        a = len(movies_to_add)
-        log(layer=layer, message=f"{a} movies will be persisted")
-        all_unfetched_movie_ids = Movie.objects.filter(fetched=False).all().values_list('id')
-        movie_ids_to_delete = (set(all_unfetched_movie_ids).difference(tmdb_movie_ids))
-        b = 0
+    with requests.get(daily_export_url, stream=True, timeout=120) as response:
+        if response.status_code != 200:
+            log(layer=layer, message=f"Error downloading files: {response.status_code} - {response.content}")
+            return
+        log(layer=layer, message=f"Streaming {daily_export_url}")
+        lines = __log_throughput(__stream_gzip_lines(response), "TMDB daily export", layer=layer)
+        __reconcile_movie_ids(__parse_export_lines(lines, layer), layer)
+
+
+def __parse_export_lines(lines, layer):
+    for line in lines:
+        if not line.strip():
+            continue
         try:
-            log(layer=layer, message=f"Persisting {a} movies")
-            for chunk in chunks(movies_to_add, 100):
-                to_persist = list(chunk)
-                b += len(to_persist)
-                Movie.objects.insert(to_persist)
-                log(layer=layer, message=f"Persisted {b} movies out of {a}")
-            log(layer=layer, message=f"Deleting {len(movie_ids_to_delete)} unfetched movies not in tmdb anymore")
-            c = 0
-            for movie_to_delete in movie_ids_to_delete:
-                Movie.objects.get(pk=movie_to_delete).delete()
-                c += 1
-                log(layer=layer, message=f"Deleted {c} movies out of {len(movie_ids_to_delete)}")
+            data = json.loads(line)
+            if data['video'] is False and data['adult'] is False:
+                yield data['id'], data.get('popularity') or 0
         except Exception as e:
-            print("Error: %s" % e)
-            log(layer=layer, message=f"Error persisting or deleting data: {e}", e=e)
-    else:
-        log(layer=layer, message=f"Error downloading files: {response.status_code} - {response.content}")
+            log(layer=layer, message=f"This line fucked up: {line}, because of {e}", e=e)
+            print("This line fucked up: %s, because of %s" % (line, e))
 
 
-def __fetch_movie_with_id(movie_id, index):
-    api_key = os.getenv('TMDB_API', 'test')
-    url = (f"https://api.themoviedb.org/3/movie/{movie_id}?api_key={api_key}&language=en-US"
-           f"&append_to_response=alternative_titles,credits,external_ids,images,account_states,"
-           f"recommendations,watch/providers")
-    log(f"Calling url: {url}")
+def __reconcile_movie_ids(rows, layer):
     try:
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=2)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-
-        response = session.get(url, timeout=10)
-    except requests.exceptions.Timeout as exc:
-        log(f"Timed out on id: {movie_id}... trying again in 10 seconds\n{exc}")
-        time.sleep(10)
-        return __fetch_movie_with_id(movie_id, index)
-    except requests.exceptions.ConnectionError as exc:
-        log(f"ConnectionError: {exc} on url: {url}\n Trying again in 10 seconds...")
-        time.sleep(30)
-        return __fetch_movie_with_id(movie_id, index)
-    if response.status_code == 200:
-        return response.json()
-    elif response.status_code == 429 or response.status_code == 25:
-        retry_after = int(response.headers['Retry-After']) + 1
-        time.sleep(retry_after)
-        return __fetch_movie_with_id(movie_id, index)
-    elif response.status_code == 404:
-        Movie.objects.get(pk=movie_id).delete()
-        log(f"Deleting movie with id: {movie_id} as it's not in tmdb anymore")
-        return None
-    elif response.status_code == 401:
-        log(f"Unauthorized API key when calling url: {url}")
-        raise Exception(f"Unauthorized API key when calling url: {url}")
-    else:
-        log(f"What is going on?: id:{movie_id}, status:{response.status_code}, response: {response.content}")
-        raise Exception("Response: %s, Content: %s" % (response.status_code, response.content))
+        movie_ids_to_delete = reconcile_export(rows, layer=layer)
+        log(layer=layer, message=f"Deleting {len(movie_ids_to_delete)} unfetched movies not in tmdb anymore")
+        purge_movies(movie_ids_to_delete, layer=layer)
+    except Exception as e:
+        print("Error: %s" % e)
+        log(layer=layer, message=f"Error persisting or deleting data: {e}", e=e)
 
 
 @monitor(monitor_slug='fetch_tmdb_data_concurrently')
-def fetch_tmdb_data_concurrently():
-    movie_ids = Movie.objects.filter(fetched__exact=False).values_list('id')
-    length = len(movie_ids)
+def fetch_tmdb_data_concurrently(backend=None):
+    """
+    :param backend: 'threads' or 'asyncio', defaults to settings.TMDB_FETCH_BACKEND
+    """
+    length = fetch_queue.count_available()
     if not length or length == 0:
         log("No new movies to import. Going back to sleep")
         return
-    log(f"Starting import of {length} unfetched movies")
-    all_genres, all_langs, all_countries = get_statics()
+    backend = backend if backend else settings.TMDB_FETCH_BACKEND
+    log(f"Starting import of {length} unfetched movies using {backend}")
+    statics = get_statics()
+    # Movies are leased batch by batch, so overlapping runs and Celery workers never fetch the same ids
+    movie_ids = fetch_queue.iter_claimed_ids(fetch_queue.worker_id())
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_url = (executor.submit(__fetch_movie_with_id, movie_id, index) for index, movie_id
-                         in enumerate(movie_ids))
-        i = 0
-        for future in __log_progress(concurrent.futures.as_completed(future_to_url), "TMDB Fetch", length=length):
-            try:
-                data = future.result()
-                if data is not None:
-                    movie = Movie.objects.get(pk=data['id'])
-                    movie.add_fetched_info(dict(data), all_genres, all_langs, all_countries)
-                    movie.save()
-                i += 1
-            except Exception as exc:
-                log(message=f"Could not process data: {exc}", e=exc)
+    movie_ids = __log_progress(movie_ids, "TMDB Fetch", length=length)
+
+    with fetch_queue.movie_writer() as writer:
+        if backend == 'asyncio':
+            fetch_movies_async(movie_ids, lambda data: fetch_queue.persist_fetched_movie(data, writer, *statics),
+                               fetch_queue.dead_letter)
+        else:
+            fetch_queue.fetch_and_persist(movie_ids, writer, statics)
+    archive.flush()
+
+
+def fetch_tmdb_data_distributed():
+    """Splits the unfetched movies into Celery tasks, each leasing and fetching one batch"""
+    length = fetch_queue.count_available()
+    batch_size = settings.TMDB_CLAIM_BATCH_SIZE
+    tasks = (length + batch_size - 1) // batch_size
+    for _ in range(tasks):
+        fetch_tmdb_batch_task.delay(batch_size)
+    log(f"Queued {tasks} fetch tasks for {length} unfetched movies")
 
 
 def import_genres():
     log("Importing genres")
     api_key = os.getenv('TMDB_API', 'test')
     url = f"https://api.themoviedb.org/3/genre/movie/list?api_key={api_key}&language=en-US"
-    response = requests.get(url, stream=True, timeout=10)
+    response = tmdb_client.get(url, timeout=10)
     layer = get_channel_layer()
     if response.status_code == 200:
         genres_from_json = json.loads(response.content)['genres']
@@ -174,6 +121,7 @@ def import_genres():
                 i += 1
                 Genre(id=genre['id'], name=genre['name']).save()
         log(layer=layer, message=f"Fetched {length} genres")
+        bump_reference_data_version()
     else:
         log(layer=layer, message=f"Error importing countries: {response.status_code} - {response.content}")
 
@@ -182,7 +130,7 @@ def import_countries():
     print("Importing countries")
     api_key = os.getenv('TMDB_API', 'test')
     url = f"https://api.themoviedb.org/3/configuration/countries?api_key={api_key}"
-    response = requests.get(url, stream=True, timeout=10)
+    response = tmdb_client.get(url, timeout=10)
     layer = get_channel_layer()
     if response.status_code == 200:
         countries_from_json = json.loads(response.content)
@@ -194,6 +142,7 @@ def import_countries():
                 i += 1
                 ProductionCountries(iso_3166_1=country['iso_3166_1'], name=country['english_name']).save()
         log(layer=layer, message=f"Fetched {length} countries")
+        bump_reference_data_version()
     else:
         log(layer=layer, message=f"Error importing countries: {response.status_code} - {response.content}")
 
@@ -202,7 +151,7 @@ def import_languages():
     log("Importing languages")
     api_key = os.getenv('TMDB_API', 'test')
     url = f"https://api.themoviedb.org/3/configuration/languages?api_key={api_key}"
-    response = requests.get(url, stream=True, timeout=10)
+    response = tmdb_client.get(url, timeout=10)
     layer = get_channel_layer()
     if response.status_code == 200:
         languages_from_json = json.loads(response.content)
@@ -214,19 +163,28 @@ def import_languages():
                 i += 1
                 SpokenLanguage(iso_639_1=language['iso_639_1'], name=language['english_name']).save()
         log(layer=layer, message=f"Fetched {length} languages")
+        bump_reference_data_version()
     else:
         log(f"Error importing languages: {response.status_code} - {response.content}")
 
 
 
-def populate_discovery_movies():
+def populate_discovery_movies(mode=None):
     """
     Main function to populate the DiscoveryMovie collection from Movie collection.
     Processes movies in chunks and delegates to Celery workers.
+    :param mode: One of DISCOVERY_REBUILD_MODES, defaults to settings.DISCOVERY_REBUILD_MODE
     """
+    mode = mode if mode else settings.DISCOVERY_REBUILD_MODE
     layer = get_channel_layer()
-    log(layer=layer, message="Starting DiscoveryMovie population")
-    
+    log(layer=layer, message=f"Starting DiscoveryMovie population using {mode}")
+    if mode == 'merge':
+        __merge_discovery_movies(layer)
+        return
+    if mode == 'shadow':
+        rebuild_discovery_shadow(settings.DISCOVERY_MERGE_PARTITIONS, settings.DISCOVERY_SHADOW_WORKERS, layer=layer)
+        return
+
     # Get all movie IDs that should be in DiscoveryMovie
     qs = Movie.objects.filter(
         fetched=True,
@@ -252,11 +210,19 @@ def populate_discovery_movies():
     log(layer=layer, message=f"Finished queuing {total_movies} movies for processing")
     print("Done - all tasks queued")
 
+
+def __merge_discovery_movies(layer):
+    ranges = id_ranges(settings.DISCOVERY_MERGE_PARTITIONS)
+    for lower, upper in ranges:
+        merge_discovery_movies_task.delay(lower, upper)
+    log(layer=layer, message=f"Queued {len(ranges)} id ranges for merging into DiscoveryMovie")
+
+
 def import_providers():
     log("Importing providers")
     api_key = os.getenv('TMDB_API', 'test')
     url = f"https://api.themoviedb.org/3/watch/providers/movie?language=en-US?api_key={api_key}"
-    response = requests.get(url, stream=True, timeout=10)
+    response = tmdb_client.get(url, timeout=10)
     layer = get_channel_layer()
     if response.status_code == 200:
         providers_from_json = json.loads(response.content)['results']
@@ -268,6 +234,7 @@ def import_providers():
                 i += 1
                 WatchProvider(**provider).save()
         log(layer=layer, message=f"Fetched {length} providers")
+        bump_reference_data_version()
     else:
         log(f"Error importing providers: {response.status_code} - {response.content}")
 
@@ -284,26 +251,38 @@ def check_which_movies_needs_update(start_date, end_date):
     :param end_date: Defaults to today
     """
     api_key = os.getenv('TMDB_API', 'test')
-    page = 1
-    url = (f"https://api.themoviedb.org/3/movie/changes?api_key={api_key}&"
-           f"start_date={start_date}&end_date={end_date}&page={page}")
-    response = requests.get(url, stream=True, timeout=20)
+
+    def fetch_page(page):
+        url = (f"https://api.themoviedb.org/3/movie/changes?api_key={api_key}&"
+               f"start_date={start_date}&end_date={end_date}&page={page}")
+        return tmdb_client.get(url, timeout=20)
+
     layer = get_channel_layer()
-    if response.status_code == 200:
-        data = json.loads(response.content)
-        for movie in __log_progress(data['results'], "TMDB Changes"):
-            if not movie['adult'] and movie['id']:
-                try:
-                    db = Movie.objects.get(pk=movie['id'])
-                    if db.fetched and db.fetched_date.strftime("%Y-%m-%d") < end_date:
-                        Movie.objects.filter(pk=movie['id']).update(fetched=False)
-                        log("Scheduling movieId:%s for update" % movie['id'], layer=layer)
-                    else:
-                        log(layer=layer, message=f"MovieId: {movie['id']} has already been scheduled for update")
-                except DoesNotExist:
-                    Movie(id=movie['id'], fetched=False).save()
-    else:
+    response = fetch_page(1)
+    if response.status_code != 200:
         log(f"Response: {response.status_code}:{response.content}")
+        return
+    first_page = json.loads(response.content)
+    total_pages = first_page.get('total_pages', 1)
+    results = list(first_page['results'])
+    # A failed page is logged and skipped, the movies of every other page are still rescheduled
+    with concurrent.futures.ThreadPoolExecutor(max_workers=settings.TMDB_FETCH_THREADS) as executor:
+        pages = {executor.submit(fetch_page, page): page for page in range(2, total_pages + 1)}
+        for future in concurrent.futures.as_completed(pages):
+            page = pages[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                log(layer=layer, message=f"Changes page {page} failed: {e}", e=e)
+                continue
+            if response.status_code == 200:
+                results.extend(json.loads(response.content)['results'])
+            else:
+                log(layer=layer, message=f"Changes page {page} failed: {response.status_code}:{response.content}")
+
+    movie_ids = {movie['id'] for movie in results if not movie.get('adult') and movie.get('id')}
+    log(layer=layer, message=f"Found {len(movie_ids)} changed movies on {total_pages} pages")
+    reschedule_changed_movies(movie_ids, datetime.datetime.strptime(end_date, "%Y-%m-%d"), layer=layer)
 
 
 @monitor(monitor_slug='cron_endpoint_for_checking_updateable_movies')
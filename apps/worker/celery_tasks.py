@@ -1,53 +1,102 @@
+import time
+from datetime import datetime
+
 from celery import shared_task
 from channels.layers import get_channel_layer
 from django.db import transaction
+from pymongo import ReplaceOne, UpdateOne, UpdateMany
 
-from apps.app.helper import log
-from apps.app.db_models import Movie, Title, AlternativeTitles, DiscoveryMovie
+from apps.app.discovery import sync_discovery_movies, merge_discovery_movies, discovery_documents
+from apps.app.helper import log, get_statics
+from apps.app.db_models import Movie, Title, AlternativeTitles, DiscoveryMovie, get_reference_data, tz
 from apps.app.meilisearch_client import client
+from apps.app.models import SearchMovie
+from apps.app.search_index import search_documents, MOVIES_INDEX
+from apps.tmdb import fetch_queue, archive
 
 
 @shared_task
 def redo_countries(movie_ids):
-    def work(movie: Movie):
-        Movie.objects(id=movie.id).update_one(set__guessed_country=movie.guess_country())
-
+    """
+    Re-guess the country of a chunk of movies in memory, and write back the ones that changed in one bulk_write.
+    Their discoverymovie rows follow, as a changed country can move a movie in or out of discovery.
+    Returns the number of movies whose guessed country changed.
+    """
     layer = get_channel_layer()
     try:
-        with transaction.atomic():
-            [work(movie) for movie in Movie.objects(pk__in=movie_ids).only('id',
-                                                                           'original_language',
-                                                                           'origin_country',
-                                                                           'production_countries',
-                                                                           'production_companies')]
-        log(message=f"Processed {len(movie_ids)} movies, guestimating countries", layer=layer)
+        collection = Movie._get_collection()
+        changed = dict()
+        for doc in collection.find({'_id': {'$in': list(movie_ids)}}, Movie.COUNTRY_FIELDS):
+            guessed_country = Movie.guess_country_of_document(doc)
+            if guessed_country != doc.get('guessed_country'):
+                changed[doc['_id']] = UpdateOne({'_id': doc['_id']}, {'$set': {'guessed_country': guessed_country},
+                                                                      '$currentDate': {'updated_date': True}})
+        if changed:
+            collection.bulk_write(list(changed.values()), ordered=False)
+            sync_discovery_movies({'_id': {'$in': list(changed.keys())}}, layer=layer)
+        log(message=f"Processed {len(movie_ids)} movies, guestimating countries, {len(changed)} changed",
+            layer=layer)
+        return len(changed)
     except Exception as e:
-        log(message=f"Error handling: {movie_ids} in redo_countries with error: e", layer=layer, e=e)
+        log(message=f"Error handling: {movie_ids} in redo_countries with error: {e}", layer=layer, e=e)
 
 
 @shared_task
-def import_imdb_ratings_task(csv_rows_chunk):
-    def make_entity(db: Movie, csv):
-        db.imdb_vote_average = float(csv[1])
-        db.imdb_vote_count = int(csv[2])
-        db.calculate_weighted_rating_bayes()
-        return db
+def fetch_tmdb_batch_task(batch_size):
+    """
+    Lease a batch of unfetched movies, fetch them from TMDB and write them back.
+    Movies that fail keep their lease until it expires, and are then picked up by a later task.
+    """
+    claimant = fetch_queue.worker_id()
+    movie_ids = fetch_queue.claim_movies(claimant, batch_size)
+    if not movie_ids:
+        return 0
+    statics = get_statics()
+    with fetch_queue.movie_writer() as writer:
+        fetch_queue.fetch_and_persist(movie_ids, writer, statics)
+    archive.flush()
+    log(message=f"{claimant} fetched {writer.written} out of {len(movie_ids)} leased movies")
+    return writer.written
 
+
+@shared_task
+def import_imdb_ratings_task(csv_rows_chunk):
+    """
+    Write the IMDB ratings of a chunk in one bulk_write, with weighted_rating recomputed server side
+    against the current prior, and bring the discoverymovie rows of the rated movies up to date.
+    updated_date only moves for movies whose rating changed, so the search index doesn't push the rest again.
+    """
     movies = dict()
     try:
         [movies.setdefault(movie[0], movie) for movie in csv_rows_chunk]
-
-        data = Movie.objects.filter(imdb_id__in=[csv_row[0] for csv_row in csv_rows_chunk])
-        with transaction.atomic():
-            for movie in [make_entity(d, movies[d.imdb_id]) for d in data]:
-                Movie.objects(pk=movie.id).update(set__imdb_vote_average=movie.imdb_vote_average,
-                                                  set__imdb_vote_count=movie.imdb_vote_count,
-                                                  set__weighted_rating=movie.weighted_rating)
+        weighted_rating = Movie.weighted_rating_expression(*get_reference_data().rating_prior)
+        rating = ['$imdb_vote_average', '$imdb_vote_count', '$weighted_rating']
+        operations = [UpdateMany({'imdb_id': imdb_id},
+                                 [{'$set': {'_previous_rating': rating,
+                                            'imdb_vote_average': float(csv[1]), 'imdb_vote_count': int(csv[2])}},
+                                  {'$set': {'weighted_rating': weighted_rating}},
+                                  {'$set': {'updated_date': {'$cond': [{'$ne': ['$_previous_rating', rating]},
+                                                                       '$$NOW', '$updated_date']}}},
+                                  {'$unset': '_previous_rating'}])
+                      for imdb_id, csv in movies.items()]
+        if operations:
+            Movie._get_collection().bulk_write(operations, ordered=False)
+            sync_discovery_movies({'imdb_id': {'$in': list(movies.keys())}})
         log(message=f"Processed {len(csv_rows_chunk)} ratings")
     except Exception as e:
         log(message=f"Failed processing ratings for ids: {movies.keys()} due to error: {e}", e=e)
 
 
+@shared_task
+def recompute_weighted_ratings_task():
+    """
+    Recompute the weighted rating prior and every weighted_rating, as the callback of the ratings import chunks
+    """
+    # imdb_importer queues the tasks of this module, so it can only be imported once they are defined
+    from apps.imdb.imdb_importer import recompute_weighted_ratings
+    return recompute_weighted_ratings()
+
+
 @shared_task
 def import_imdb_titles_task(chunk):
     chunked_map = dict()
@@ -55,17 +104,22 @@ def import_imdb_titles_task(chunk):
         [chunked_map.setdefault(x[0], []).append({"alt_title": x[2], "iso": x[3]}) for x in chunk]
         with transaction.atomic():
             for fetched in Movie.objects.filter(imdb_id__in=list(chunked_map.keys())):
+                changed = False
                 for alt in chunked_map.get(fetched.imdb_id):
                     iso = alt['iso']
                     title = alt['alt_title']
                     if not fetched.alternative_titles:
                         fetched.alternative_titles = AlternativeTitles()
-                    if iso != r'\N' and title not in fetched.alternative_titles.titles:
+                    imdb_title = Title(iso_3166_1=iso, title=title, type='IMDB')
+                    if iso != r'\N' and imdb_title not in fetched.alternative_titles.titles:
                         for t in [title for title in fetched.alternative_titles.titles if
                                   title.iso_3166_1 == iso and title.type == 'IMDB']:
                             fetched.alternative_titles.titles.remove(t)
-                        fetched.alternative_titles.titles.append(Title(iso_3166_1=iso, title=title, type='IMDB'))
-                fetched.save()
+                        fetched.alternative_titles.titles.append(imdb_title)
+                        changed = True
+                if changed:
+                    fetched.updated_date = datetime.now(tz)
+                    fetched.save()
         log(message=f"Processed {len(chunk)} titles")
     except Exception as e:
         log(message=f"Failed processing ratings for ids: {chunked_map.keys()} due to error: {e}", e=e)
@@ -74,125 +128,47 @@ def import_imdb_titles_task(chunk):
 @shared_task
 def populate_discovery_movie_task(chunk):
     """
-    Process a chunk of movie IDs and populate DiscoveryMovie collection
+    Project a chunk of movie IDs into the DiscoveryMovie collection, with one unordered bulk_write of upserts.
+    Returns the number of movies written, the number skipped as not belonging in discovery, and the seconds it took.
     """
+    started = time.monotonic()
     try:
-        movies = Movie.objects.filter(
-            id__in=chunk
-        ).only(
-            'id',
-            'imdb_id',
-            'original_title',
-            'title',
-            'poster_path',
-            'vote_average',
-            'vote_count',
-            'imdb_vote_average',
-            'imdb_vote_count',
-            'guessed_country',
-            'release_date',
-            'credits',
-            'genres',
-            'weighted_rating',
-            'overview',
-            'fetched',
-            'guessed_country'
-        )
-        
-        discovery_movies = []
-        
-        for movie in [ movie for movie in movies if movie.fetched and movie.guessed_country ]:
-            # Extract director from credits
-            director = None
-            if movie.credits and movie.credits.crew:
-                directors = [
-                    crew.name for crew in movie.credits.crew 
-                    if crew.job == "Director"
-                ]
-                director = directors[0] if directors else None
-            
-            # Extract year from release_date
-            year = None
-            if movie.release_date:
-                try:
-                    year = movie.release_date.split('-')[0]
-                except (AttributeError, IndexError):
-                    pass
-            
-            # Get genre names
-            genre_names = [genre.name for genre in movie.genres] if movie.genres else []
-            
-            english_title = movie.title if movie.title else ""
-            
-            # Create or update DiscoveryMovie
-            discovery_movie = DiscoveryMovie(
-                id=movie.id,
-                imdb_id=movie.imdb_id,
-                original_title=movie.original_title,
-                english_title=english_title,
-                poster_path=movie.poster_path,
-                vote_average=movie.vote_average if movie.vote_average else 0.0,
-                vote_count=movie.vote_count if movie.vote_count else 0,
-                estimated_country=movie.guessed_country,
-                year=year,
-                director=director,
-                genres=genre_names,
-                weighted_rating=movie.weighted_rating if movie.weighted_rating else 0.0,
-                overview=movie.overview
-            )
-            
-            discovery_movies.append(discovery_movie)
-        
-        # Bulk save with upsert
-        for dm in discovery_movies:
-            dm.save()
-        
-        log(message=f"Processed {len(discovery_movies)} movies into DiscoveryMovie collection")
-        return len(discovery_movies)
-        
+        operations = [ReplaceOne({'_id': movie_id}, document, upsert=True)
+                      for movie_id, document in discovery_documents({'_id': {'$in': list(chunk)}}) if document]
+        skipped = len(chunk) - len(operations)
+        written = 0
+        if operations:
+            result = DiscoveryMovie._get_collection().bulk_write(operations, ordered=False)
+            written = result.upserted_count + result.matched_count
+        seconds = time.monotonic() - started
+        log(message=f"Processed {len(chunk)} movies into DiscoveryMovie collection, {written} written and "
+                    f"{skipped} skipped in {seconds:.2f}s")
+        return {'written': written, 'skipped': skipped, 'seconds': seconds}
+
     except Exception as e:
         error_msg = f"Failed processing discovery movies for chunk due to error: {e}"
         log(message=error_msg, e=e)
         raise
 
 
-
-def extract_directors(crew):
-    return [member.name for member in crew if member.job == "Director"]
-
-def extract_alternative_titles(alt_titles):
-    if not alt_titles:
-        return []
-    return [title.title for title in alt_titles.titles if title.title]
+@shared_task
+def merge_discovery_movies_task(lower, upper):
+    """
+    Rebuild the discoverymovie rows of one id range server side, see merge_discovery_movies
+    """
+    try:
+        merge_discovery_movies(lower, upper)
+    except Exception as e:
+        log(message=f"Failed merging discovery movies with ids {lower} to {upper} due to error: {e}", e=e)
+        raise
 
 
 @shared_task
 def index_movies(chunk):
-    index = client.index("movies")
+    index = client.index(MOVIES_INDEX)
     try:
-        movies = Movie.objects.filter(
-                id__in=chunk
-            )
-        documents = [
-            {
-            "id": movie.id,
-            "title": movie.title,
-            "original_title": movie.original_title,
-            "alternative_titles": extract_alternative_titles(movie.alternative_titles),
-            "overview": movie.overview,
-            "directors": extract_directors(movie.credits.crew) if movie.credits else [],
-            "weighted_rating": movie.weighted_rating,
-            "vote_average": (movie.vote_average + movie.imdb_vote_average) / 2,
-            "vote_count": movie.vote_count + movie.imdb_vote_count,
-            "guessed_country": movie.guessed_country,
-            "original_language": movie.original_language,
-            "poster": movie.poster_path,
-            "year": movie.release_date[:4]
-        }
-            for movie in movies
-        ]
-        index.add_documents(documents)
+        movies = list(Movie._get_collection().find({'_id': {'$in': list(chunk)}}, SearchMovie.FIELDS))
+        index.add_documents(search_documents(movies))
         log(message=f"Indexed {len(chunk)} movies")
     except Exception as e:
         log(message="Failed to index due to error: %s" % e, e=e)
-
@@ -0,0 +1,100 @@
+"""Per-movie cost of Movie.guess_country over the movies in testdata/.
+
+    python -m benchmarks.guess_country [rounds]
+
+Compares the territory lookup guess_country used to do per movie, one Babel get_territory_language_info()
+call per territory speaking the language, against the precomputed get_language_territories() table.
+Runs without mongo, the reference data is read straight from testdata/.
+"""
+import glob
+import json
+import sys
+import time
+
+from apps.app.db_models import (Movie, Genre, SpokenLanguage, ProductionCountries, get_all_countries,
+                                get_language_territories, get_territory_language_info)
+
+# Reference data and the json lines daily export, every other json file is a movie payload or has no language
+SKIPPED_FILES = ('countries.json', 'languages.json', 'genres.json', 'watch_providers.json', 'movie_ids.json')
+
+
+def load_statics():
+    with open("testdata/genres.json", 'rb') as genres:
+        all_genres = {x['id']: Genre(**x) for x in json.loads(genres.read()).get('genres')}
+    with open("testdata/languages.json", 'rb') as langs:
+        all_langs = {x['iso_639_1']: SpokenLanguage(**x) for x in json.loads(langs.read())}
+    with open("testdata/countries.json", 'rb') as countries:
+        all_countries = {x['iso_3166_1']: ProductionCountries(**x) for x in json.loads(countries.read())}
+    return all_genres, all_langs, all_countries
+
+
+def load_movies(statics):
+    movies = []
+    for path in sorted(glob.glob("testdata/*.json")):
+        if path.endswith(SKIPPED_FILES):
+            continue
+        try:
+            with open(path, 'rb') as file:
+                data = json.loads(file.read())
+            if 'original_language' not in data:
+                continue
+            movie = Movie(id=data['id'])
+            movie.add_fetched_info(data, *statics)
+            movies.append(movie)
+        except Exception as e:
+            print(f"Skipping {path}: {e}")
+    return movies
+
+
+def legacy_territories(original_language):
+    """The lookup guess_country did for every movie before get_language_territories"""
+    territories_with_percentage = []
+    for territory in get_all_countries().get(original_language, []):
+        infos = get_territory_language_info(territory)
+        for info in infos.items():
+            official_status = info[1].get('official_status')
+            percentage = info[1].get('population_percent')
+            if info[0] == original_language and official_status == 'official':
+                territories_with_percentage.append({"territory": territory, "percentage": percentage})
+    territories_with_percentage.sort(key=lambda item: item.get('percentage'))
+    return territories_with_percentage
+
+
+def table_territories(original_language):
+    return get_language_territories().get(original_language, ())
+
+
+def timed(name, func, movies, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for movie in movies:
+            func(movie)
+    per_movie = (time.perf_counter() - started) / (rounds * len(movies)) * 1_000_000
+    print(f"{name:<28} {per_movie:>10.1f} µs/movie")
+    return per_movie
+
+
+def main(rounds=200):
+    # AppConfig.ready() warms the table when django is set up, so a fresh build is timed
+    get_language_territories.cache_clear()
+    started = time.perf_counter()
+    get_language_territories()
+    print(f"Built the language table once in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    movies = load_movies(load_statics())
+    languages = sorted({movie.original_language for movie in movies if movie.original_language})
+    for language in languages:
+        legacy = [(x['territory'], x['percentage']) for x in legacy_territories(language)]
+        assert legacy == list(table_territories(language)), f"Table differs from Babel for {language}"
+    print(f"{len(movies)} movies, languages: {', '.join(languages)}, {rounds} rounds")
+
+    before = timed("territories, per territory", lambda movie: legacy_territories(movie.original_language),
+                   movies, rounds)
+    after = timed("territories, table", lambda movie: table_territories(movie.original_language),
+                  movies, rounds)
+    timed("guess_country", lambda movie: movie.guess_country(), movies, rounds)
+    print(f"Territory lookup is {before / max(after, 1e-9):.0f}x faster")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
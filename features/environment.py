@@ -2,7 +2,8 @@ import os
 
 from django.db import transaction
 from django.conf import settings
-from apps.app.db_models import Movie
+from apps.app.db_models import Movie, MovieDetails, DiscoveryMovie, DeletedMovie, FetchDeadLetter, RatingPrior, \
+    SearchIndexState, bump_reference_data_version
 from behave.fixture import use_fixture
 from behave import fixture
 
@@ -39,6 +40,14 @@ def after_scenario(context, feature):
         context.mocker.stop()
     with transaction.atomic():
         Movie.objects.all().delete()
+        MovieDetails.objects.all().delete()
+        DiscoveryMovie.objects.all().delete()
+        DeletedMovie.objects.all().delete()
+        FetchDeadLetter.objects.all().delete()
+        SearchIndexState.objects.all().delete()
+    if RatingPrior.objects.count():
+        RatingPrior.objects.all().delete()
+        bump_reference_data_version()
     for i in ['title.akas.tsv.gz', 'title.ratings.tsv.gz']:
         if os.path.exists(i):
             os.remove(i)
@@ -18,6 +18,27 @@ Feature: IMDB Imports
     And imdb_id=tt0000001 should have imdb_ratings set to 5.8 eventually
     And imdb_id=tt0000002 should not be found
 
+  Scenario: Import Ratings Recomputes The Weighted Rating Prior Afterwards
+    Given movies "[{"id": 1, "imdb_id": "tt0000001", "fetched": true}]" is persisted
+    And "https://datasets.imdbws.com/title.ratings.tsv.gz" is zip-mocked with "mini_ratings.tsv"
+    When calling /import/imdb/ratings
+    Then http status should be 200
+    And imdb_id=tt0000001 should have imdb_ratings set to 5.8 eventually
+    And the weighted rating prior should have been recomputed eventually
+
+  Scenario Outline: Import Ratings Only Moves updated_date When The Rating Changed
+    Given movies "[{"id": 1, "imdb_id": "tt0000001", "fetched": true}]" is persisted
+    And the ratings row "tt0000001 5.8 1524" is imported
+    And id=1 was last updated on 2000-01-01
+    When the ratings row "<row>" is imported
+    Then id=1 should have been last updated <when> 2000-01-01
+
+    Examples: Rows
+      | row                | when  |
+      | tt0000001 5.8 1524 | on    |
+      | tt0000001 6.1 1524 | after |
+      | tt0000001 5.8 1600 | after |
+
   Scenario: Import Titles Happy Case
     Given movies "[{"id": 1, "imdb_id": "tt0000001"}]" is persisted
     And "https://datasets.imdbws.com/title.akas.tsv.gz" is zip-mocked with "mini_akas.tsv"
@@ -32,3 +53,19 @@ Feature: IMDB Imports
     Then http status should be 200
     And imdb_id=tt0000001 should have imdb_alt_titles "Carmencita - spanyol tánc,Καρμενσίτα,Карменсита" set eventually
     And imdb_id=tt0000002 should not be found
+
+  Scenario: Import Titles Leaves Movies Whose Titles Are Unchanged Alone
+    Given movies "[{"id": 1, "imdb_id": "tt0000001"}]" is persisted
+    And "https://datasets.imdbws.com/title.akas.tsv.gz" is zip-mocked with "mini_akas.tsv"
+    When calling /import/imdb/titles
+    And imdb_id=tt0000001 should have imdb_alt_titles "Carmencita - spanyol tánc,Καρμενσίτα,Карменсита" set eventually
+    And id=1 was last updated on 2000-01-01
+    And the titles of mini_akas.tsv are imported again
+    Then id=1 should have been last updated on 2000-01-01
+
+  Scenario: Recompute Weighted Ratings Against The Catalogue Mean
+    Given movies "[{"id": 1, "fetched": true, "vote_average": 8.0, "vote_count": 100}, {"id": 2, "fetched": true, "vote_average": 6.0, "vote_count": 100}]" is persisted
+    When calling /redo/weightedratings
+    Then http status should be 200
+    And id=1 should have weighted_rating set to 7.33 eventually
+    And id=2 should have weighted_rating set to 6.67 eventually
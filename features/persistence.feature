@@ -24,8 +24,27 @@ Feature: Persistence Logics
       # Stalker: Made by Soviet
       | 1398.json   | 1398 | SU              |
 
-  Scenario: Guessed country update
-    Given movies from file:sjunde_inseglet.json is persisted
-    And guessed_country field is nulled for id=490
+  Scenario Outline: Guessed country update
+    Given movies from file:<mocked_data> is persisted
+    And guessed_country field is nulled for id=<id>
     When calling /redo/guestimation
-    Then id=490 should have country set to SE eventually
+    Then id=<id> should have country set to <guessed_country> eventually
+
+    Examples: Re-guessed from the raw documents
+      | mocked_data          | id     | guessed_country |
+      | sjunde_inseglet.json | 490    | SE              |
+      | 103663.json          | 103663 | DK              |
+      | incendies.json       | 46738  | CA              |
+      | 1398.json            | 1398   | SU              |
+
+  Scenario: Movie Writes Survive A Failed Write In A Batch Flushed Mid-Import
+    Given movies "[{"id": 601, "fetched": true, "fetched_date": "2030-01-01"}]" is persisted
+    When 601.json is written over a newer stored copy, then 602.json, in batches of 2
+    Then the batch should have been flushed mid-import, with 1 write landed and 1 failed
+    And the failed write should have been logged
+    And id=602 should be discoverable from US in 1996, directed by Roland Emmerich eventually
+
+  Scenario: A Batch Lost To A Connection Error Is Counted As Failed
+    When a batch of 2 writes is flushed while mongo is unreachable
+    Then the batch should have been flushed mid-import, with 0 write landed and 2 failed
+    And the failed write should have been logged
@@ -0,0 +1,31 @@
+Feature: TMDB Rate Limiter
+
+  Scenario: A 429 Halves The Rate And Holds Back Every Caller
+    Given a rate limiter at 10 requests per second with a burst of 10
+    When a 429 with Retry-After 2 is reported
+    Then the rate should be 5
+    And another caller sharing the limiter should wait at least 2 seconds
+    When a 429 with Retry-After 2 is reported
+    Then the rate should be 5
+
+  Scenario: Quick Successes Raise The Rate Up To The Cap
+    Given a rate limiter at 10 requests per second, capped at 11
+    When 5 quick successes are reported
+    Then the rate should be 10.25
+    When 100 quick successes are reported
+    Then the rate should be 11
+
+  Scenario: Reservations Wait Once The Bucket Is Empty
+    Given a rate limiter at 10 requests per second with a burst of 2
+    Then the next 2 reservations should not wait
+    And the next reservation should wait 0.1 seconds
+
+  Scenario Outline: Retry-After Headers In Either Form
+    Then a Retry-After of "<header>" should hold back for <seconds> seconds
+
+    Examples: Headers
+      | header                        | seconds |
+      | 5                             | 5       |
+      | -3                            | 0       |
+      | Wed, 21 Oct 2015 07:28:00 GMT | 0       |
+      | soon                          | 1       |
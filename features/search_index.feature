@@ -0,0 +1,33 @@
+Feature: Search Index
+
+  Background:
+    Given all basics are present in mongo
+
+  Scenario: Only Movies Changed Since The Watermark Are Indexed
+    Given movies from file:601.json is persisted
+    And movies from file:602.json is persisted
+    And id=601 was last updated on 2030-01-01
+    And id=602 was last updated on 2000-01-01
+    And the search index watermark is at 2020-01-01
+    And id=999 was deleted from mongo
+    And meilisearch is mocked
+    When calling /index/movies/changes
+    Then http status should be 200
+    And the search index watermark should have moved to 2030-01-01 eventually
+    And meilisearch should have been sent id=601 only
+    And meilisearch should have been asked to delete id=999
+    And there should be no tombstones left
+
+  Scenario Outline: Indexing Changed Movies Waits For Another Run's Live Lease
+    Given movies from file:601.json is persisted
+    And id=601 was last updated on 2030-01-01
+    And the search index watermark is at 2020-01-01
+    And the search index is leased by another run until <lease_expiry>
+    And meilisearch is mocked
+    When the changed movies are indexed
+    Then <indexed> movies should have been indexed
+
+    Examples: Leases
+      | lease_expiry | indexed |
+      | 2999-01-01   | 0       |
+      | 2000-01-01   | 1       |
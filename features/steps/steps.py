@@ -3,15 +3,38 @@ import gzip
 import io
 import json
 import os
+import shutil
+import tempfile
 import time
+import requests
 import requests_mock
+from aioresponses import aioresponses
 import codecs
+import csv
+import threading
+from unittest.mock import MagicMock, patch
 
+from django.conf import settings
 from mongoengine import DoesNotExist
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import AutoReconnect
 
+from apps.app import discovery
+from apps.app.bulk_writer import BulkWriter, MovieWriter
 from apps.app.helper import get_statics
-from apps.app.db_models import SpokenLanguage, ProductionCountries, Genre, Movie, WatchProvider
-from behave import given, then, step
+from apps.app.db_models import SpokenLanguage, ProductionCountries, Genre, Movie, MovieDetails, WatchProvider, \
+    DiscoveryMovie, DeletedMovie, FetchDeadLetter, SearchIndexState, bump_reference_data_version, \
+    RatingPrior, get_reference_data, record_deleted_movies
+from apps.app.rate_limiter import RateLimiter
+from apps.app.search_index import MOVIES_INDEX, get_watermark, save_watermark, index_changed_movies
+from apps.tmdb import archive
+from apps.worker.celery_tasks import populate_discovery_movie_task, import_imdb_ratings_task, \
+    import_imdb_titles_task
+from apps.tmdb.fetch_queue import claim_movies, DEAD_LETTER, PARKED
+from apps.tmdb.tmdb_client import parse_retry_after
+from apps.tmdb.reconcile import insert_movie_stubs, reconcile_export
+from behave import given, when, then, step
 
 
 @given("all basics are present in mongo")
@@ -24,6 +47,7 @@ def all_basics(context):
         [ProductionCountries(**x).save() for x in json.loads(countries.read())]
     with open("testdata/watch_providers.json", 'rb') as providers:
         [WatchProvider(**x).save() for x in json.loads(providers.read())["results"]]
+    bump_reference_data_version()
 
 
 @given(u'basics are present in mongo')
@@ -52,6 +76,7 @@ def given_basics_are_present(context):
     Genre(id=878, name="Science Fiction").save()
     Genre(id=18, name="Drama").save()
     Genre(id=10751, name="Family").save()
+    bump_reference_data_version()
 
 
 @given(u'movies "{json_data}" is persisted')
@@ -106,6 +131,51 @@ def response_should_contain(context, expected):
     context.test.assertContains(response=context.response, text=expected)
 
 
+@when("{stale} is written over a newer stored copy, then {fresh}, in batches of {batch_size}")
+def write_batch_with_a_failure(context, stale, fresh, batch_size):
+    movies = []
+    for file in (stale, fresh):
+        with open(f"testdata/{file}", 'rb') as raw:
+            data = json.loads(raw.read())
+        movie = Movie(id=data['id'])
+        movie.add_fetched_info(data, *get_statics())
+        movies.append(movie)
+    rating_prior = get_reference_data().rating_prior
+    with patch('apps.app.bulk_writer.log') as logged, \
+            MovieWriter("Test writes", batch_size=int(batch_size)) as writer:
+        # The stored copy is newer, so the guarded upsert collides with its _id and fails
+        writer.add_movie(movies[0], {'_id': movies[0].id, 'fetched_date': {'$lte': movies[0].fetched_date}},
+                         rating_prior, upsert=True)
+        writer.add_movie(movies[1], {'_id': movies[1].id}, rating_prior, upsert=True)
+        context.pending = len(writer)
+    context.writer, context.logged = writer, logged
+
+
+@when("a batch of {batch_size} writes is flushed while mongo is unreachable")
+def flushed_while_unreachable(context, batch_size):
+    collection = MagicMock()
+    collection.bulk_write.side_effect = AutoReconnect('connection reset')
+    with patch('apps.app.bulk_writer.log') as logged, \
+            BulkWriter(collection, "Test writes", batch_size=int(batch_size)) as writer:
+        for movie_id in range(int(batch_size)):
+            writer.add(UpdateOne({'_id': movie_id}, {'$set': {'fetched': False}}))
+        context.pending = len(writer)
+    context.writer, context.logged = writer, logged
+
+
+@then("the batch should have been flushed mid-import, with {written} write landed and {failed} failed")
+def flushed_with_failure(context, written, failed):
+    context.test.assertEqual(context.pending, 0, "The batch should have been flushed once it was full")
+    context.test.assertEqual(context.writer.written, int(written))
+    context.test.assertEqual(context.writer.failed, int(failed))
+
+
+@then("the failed write should have been logged")
+def failed_write_logged(context):
+    messages = [call.kwargs.get('message', '') for call in context.logged.call_args_list]
+    context.test.assertTrue(any('writes failed' in message for message in messages), messages)
+
+
 @given("tmdb file is mocked with {data}")
 def mock_tmdb_file(context, data):
     yesterday = datetime.date.today() - datetime.timedelta(days=1)
@@ -126,7 +196,177 @@ def mock_tmdb_data(context, data, movie_id, status):
             api_key='test', movie_id=movie_id)
     start_mock(context)
     with open(f"testdata/{data}", 'rb') as asd:
-        context.mocker.get(url, status_code=int(status), content=asd.read())
+        content = asd.read()
+        context.mocker.get(url, status_code=int(status), content=content)
+        if hasattr(context, 'aiomocker'):
+            context.aiomocker.get(url, status=int(status), body=content, repeat=True)
+
+
+@given("the fetch backend is {backend}")
+def fetch_backend_is(context, backend):
+    previous = settings.TMDB_FETCH_BACKEND
+    settings.TMDB_FETCH_BACKEND = backend
+    context.add_cleanup(setattr, settings, 'TMDB_FETCH_BACKEND', previous)
+    if backend == 'asyncio':
+        context.aiomocker = aioresponses()
+        context.aiomocker.start()
+        context.add_cleanup(context.aiomocker.stop)
+
+
+@given("the storage profile is {profile}")
+def storage_profile_is(context, profile):
+    previous = settings.TMDB_STORAGE_PROFILE
+    settings.TMDB_STORAGE_PROFILE = profile
+    context.add_cleanup(setattr, settings, 'TMDB_STORAGE_PROFILE', previous)
+
+
+@then("id={movie_id} should be stored with the {profile} profile, {cast} cast and {crew} crew members eventually")
+def stored_with_profile(context, movie_id, profile, cast, crew):
+    context.test.assertTrue(
+        wait_function_is_true(Movie.objects.filter(pk=int(movie_id), fetched=True, storage_profile=profile), 1),
+        f"Movie with id={movie_id} should have been stored with the {profile} profile")
+    movie = Movie.objects.get(pk=int(movie_id))
+    context.test.assertEqual(len(movie.credits.cast), int(cast))
+    context.test.assertEqual(len(movie.credits.crew), int(crew))
+
+
+@given("movie details are split out")
+def movie_details_split(context):
+    previous = settings.TMDB_SPLIT_MOVIE_DETAILS
+    settings.TMDB_SPLIT_MOVIE_DETAILS = True
+    context.add_cleanup(setattr, settings, 'TMDB_SPLIT_MOVIE_DETAILS', previous)
+
+
+@given("movie details stay on the movie")
+def movie_details_not_split(context):
+    previous = settings.TMDB_SPLIT_MOVIE_DETAILS
+    settings.TMDB_SPLIT_MOVIE_DETAILS = False
+    context.add_cleanup(setattr, settings, 'TMDB_SPLIT_MOVIE_DETAILS', previous)
+
+
+@step("discovery is emptied")
+def discovery_emptied(context):
+    DiscoveryMovie.objects.all().delete()
+
+
+@step("a stale discovery movie with id={movie_id} is persisted")
+def stale_discovery_movie(context, movie_id):
+    DiscoveryMovie(id=int(movie_id), estimated_country='SE', english_title='Stale').save()
+
+
+@when("discovery is rebuilt in a shadow while id={movie_id} is moved to {country}")
+def shadow_rebuild_with_live_write(context, movie_id, country):
+    merge = discovery.merge_discovery_movies
+
+    def merge_then_write(*args, **kwargs):
+        # The shadow already holds the movie, so only the re-sync after the swap can bring the move along
+        result = merge(*args, **kwargs)
+        Movie._get_collection().update_one({'_id': int(movie_id)}, {'$set': {'guessed_country': country},
+                                                                    '$currentDate': {'updated_date': True}})
+        discovery.sync_discovery_movies({'_id': int(movie_id)})
+        return result
+
+    with patch.object(discovery, 'merge_discovery_movies', side_effect=merge_then_write):
+        discovery.rebuild_discovery_shadow(partitions=1, workers=1)
+
+
+@when("the discovery chunk {movie_ids} is populated")
+def discovery_chunk_populated(context, movie_ids):
+    context.result = populate_discovery_movie_task([int(movie_id) for movie_id in movie_ids.split(',')])
+
+
+@then("{written} movie should have been written to discovery and {skipped} skipped")
+def discovery_chunk_counts(context, written, skipped):
+    context.test.assertEqual(context.result['written'], int(written))
+    context.test.assertEqual(context.result['skipped'], int(skipped))
+
+
+@then("discovery should only hold id={movie_id} eventually")
+def discovery_only_holds(context, movie_id):
+    context.test.assertTrue(
+        wait_function_is_true(DiscoveryMovie.objects, 1),
+        f"Discovery should only hold id={movie_id}, but holds {DiscoveryMovie.objects.scalar('id')}")
+    context.test.assertEqual(list(DiscoveryMovie.objects.scalar('id')), [int(movie_id)])
+
+
+@then("id={movie_id} should still be in discovery")
+def still_in_discovery(context, movie_id):
+    context.test.assertEqual(DiscoveryMovie.objects.filter(pk=int(movie_id)).count(), 1,
+                             f"Movie with id={movie_id} should have been kept in discovery")
+
+
+@step("id={movie_id} should be discoverable from {country} in {year}, directed by {director} eventually")
+def discoverable(context, movie_id, country, year, director):
+    context.test.assertTrue(
+        wait_function_is_true(DiscoveryMovie.objects.filter(pk=int(movie_id)), 1),
+        f"Movie with id={movie_id} should have been added to discovery")
+    discovery_movie = DiscoveryMovie.objects.get(pk=int(movie_id))
+    context.test.assertEqual(discovery_movie.estimated_country, country)
+    context.test.assertEqual(discovery_movie.year, year)
+    context.test.assertEqual(discovery_movie.director, director)
+
+
+@then("id={movie_id} should have its credits in movie_details, {cast} cast and {crew} crew members eventually")
+def stored_in_movie_details(context, movie_id, cast, crew):
+    context.test.assertTrue(
+        wait_function_is_true(MovieDetails.objects.filter(pk=int(movie_id)), 1),
+        f"Movie with id={movie_id} should have had its details stored in movie_details")
+    movie = Movie._get_collection().find_one({'_id': int(movie_id)})
+    for field in Movie.DETAIL_FIELDS:
+        context.test.assertNotIn(field, movie)
+    credits = json.loads(context.test.client.get(f"/movie/{movie_id}").content)['credits']
+    context.test.assertEqual(len(credits['cast']), int(cast))
+    context.test.assertEqual(len(credits['crew']), int(crew))
+
+
+@then("id={movie_id} should have changed since the last search indexing")
+def changed_for_search(context, movie_id):
+    movie = Movie._get_collection().find_one({'_id': int(movie_id)}, {'updated_date': 1})
+    context.test.assertIsNotNone(movie.get('updated_date'), f"Movie with id={movie_id} should have an updated_date")
+
+
+@given("raw tmdb responses are archived")
+def responses_archived(context):
+    directory = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, directory, ignore_errors=True)
+    previous = settings.TMDB_ARCHIVE_DIR
+    settings.TMDB_ARCHIVE_DIR = directory
+    context.add_cleanup(setattr, settings, 'TMDB_ARCHIVE_DIR', previous)
+
+
+@then("the archive should hold id={movie_id} eventually")
+def archive_holds(context, movie_id):
+    mustend = time.time() + 5
+    while time.time() < mustend:
+        if any(record['id'] == int(movie_id) for path in archive.segments() for record in archive.read_segment(path)):
+            return
+        time.sleep(0.1)
+    context.test.fail(f"Movie with id={movie_id} should have been archived")
+
+
+@when("movies are removed from mongo")
+def movies_removed(context):
+    Movie.objects.all().delete()
+    MovieDetails.objects.all().delete()
+    DiscoveryMovie.objects.all().delete()
+
+
+@when("the archive is replayed")
+def archive_replayed(context):
+    for path in archive.segments():
+        archive.replay_segment(path)
+
+
+@when('id={movie_id} is fetched again with the title "{title}"')
+def fetched_again(context, movie_id, title):
+    Movie._get_collection().update_one({'_id': int(movie_id)},
+                                       {'$set': {'title': title,
+                                                 'fetched_date': datetime.datetime.now() + datetime.timedelta(days=1)}})
+
+
+@then('id={movie_id} should still have the title "{title}"')
+def still_titled(context, movie_id, title):
+    context.test.assertEqual(Movie.objects.get(pk=int(movie_id)).title, title)
 
 
 @then("after awhile there should be {amount} movies persisted")
@@ -136,6 +376,130 @@ def wait_for_persistence(context, amount):
         f"Movies in database: {Movie.objects.all()}, expected {amount}")
 
 
+@then("id={movie_id} should be persisted with fetched={fetched}")
+def persisted_with_fetched(context, movie_id, fetched):
+    movie = Movie.objects(pk=int(movie_id)).first()
+    context.test.assertIsNotNone(movie, f"Movie with id={movie_id} should have been kept")
+    context.test.assertEqual(str(movie.fetched), fetched)
+
+
+@then("id={movie_id} should not be persisted")
+def not_persisted(context, movie_id):
+    context.test.assertTrue(
+        wait_function_is_true(Movie.objects.filter(pk=int(movie_id)), 0),
+        f"Movie with id={movie_id} should have been deleted")
+
+
+@step("movie stubs for ids {movie_ids} are inserted")
+def insert_stubs(context, movie_ids):
+    movie_ids = [int(movie_id) for movie_id in movie_ids.split(',')]
+    context.inserted = insert_movie_stubs(movie_ids, [0.0] * len(movie_ids))
+
+
+@given("{amount} unfetched movies are persisted")
+def unfetched_movies(context, amount):
+    insert_movie_stubs(range(1, int(amount) + 1), [0.0] * int(amount))
+
+
+@when("two claimers race for them {batch_size} at a time")
+def racing_claimers(context, batch_size):
+    start = threading.Barrier(2)
+    context.claims = {'A': [], 'B': []}
+
+    def claim(claimant):
+        claimed = True
+        while claimed:
+            try:
+                # Both claimers look for candidates at the same moment, so they mostly see the same ones
+                start.wait()
+            except threading.BrokenBarrierError:
+                pass  # The other claimer is done
+            claimed = claim_movies(claimant, int(batch_size))
+            context.claims[claimant].extend(claimed)
+        start.abort()
+
+    threads = [threading.Thread(target=claim, args=(claimant,)) for claimant in context.claims]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+@then("every movie should have been claimed exactly once")
+def claimed_exactly_once(context):
+    claimed = context.claims['A'] + context.claims['B']
+    context.test.assertEqual(sorted(claimed), sorted(Movie.objects.scalar('id')))
+
+
+@when('the export is reconciled with the popularities "{rows}"')
+def export_reconciled(context, rows):
+    reconcile_export([(int(movie_id), float(popularity))
+                      for movie_id, popularity in (row.split(':') for row in rows.split(','))])
+
+
+@then("claiming one movie at a time should hand out {movie_ids}")
+def claimed_in_order(context, movie_ids):
+    claimed = []
+    while batch := claim_movies('ordered', 1):
+        claimed.extend(batch)
+    context.test.assertEqual(claimed, [int(movie_id) for movie_id in movie_ids.split(',')])
+
+
+@when("claimer {claimant} leases every movie for {seconds} seconds")
+def lease_every_movie(context, claimant, seconds):
+    context.test.assertTrue(claim_movies(claimant, Movie.objects.count(), lease_seconds=int(seconds)))
+    context.lease_seconds = int(seconds)
+
+
+@then("claimer {claimant} should get nothing")
+def claims_nothing(context, claimant):
+    context.test.assertEqual(claim_movies(claimant, 10), [])
+
+
+@then("claimer {claimant} should get id={movie_id} once the lease has run out")
+def claims_after_expiry(context, claimant, movie_id):
+    time.sleep(context.lease_seconds + 0.1)
+    context.test.assertEqual(claim_movies(claimant, 10), [int(movie_id)])
+    context.test.assertTrue(Movie.objects.get(pk=int(movie_id)).claimed_by.startswith(f"{claimant}:"))
+
+
+@given("fetches give up after {attempts} quick attempts")
+def quick_retries(context, attempts):
+    for name, value in (('TMDB_RETRY_MAX_ATTEMPTS', int(attempts)), ('TMDB_RETRY_BASE_SECONDS', 0.01)):
+        context.add_cleanup(setattr, settings, name, getattr(settings, name))
+        setattr(settings, name, value)
+
+
+@then("id={movie_id} should be dead lettered and parked eventually")
+def dead_lettered(context, movie_id):
+    context.test.assertTrue(
+        wait_function_is_true(FetchDeadLetter.objects.filter(pk=int(movie_id)), 1),
+        f"Movie with id={movie_id} should have been dead lettered")
+    movie = Movie._get_collection().find_one({'_id': int(movie_id)})
+    context.test.assertEqual(movie['claimed_by'], DEAD_LETTER)
+    context.test.assertEqual(movie['lease_expiry'], PARKED)
+
+
+@then("id={movie_id} should be claimable again eventually")
+def claimable_again(context, movie_id):
+    context.test.assertTrue(
+        wait_function_is_true(FetchDeadLetter.objects.filter(pk=int(movie_id)), 0),
+        f"Movie with id={movie_id} should have been re-driven")
+    context.test.assertEqual(claim_movies('redriven', 10), [int(movie_id)])
+
+
+@then("id={movie_id} should not be leased anymore")
+def not_leased(context, movie_id):
+    movie = Movie._get_collection().find_one({'_id': int(movie_id)})
+    context.test.assertNotIn('claimed_by', movie)
+    context.test.assertNotIn('lease_expiry', movie)
+
+
+@then("{amount} movie stubs should have been inserted")
+def stubs_inserted(context, amount):
+    context.test.assertEqual(context.inserted, int(amount))
+
+
 def wait_function_is_true(clazz, amount, timeout: float = 5, period=0.1):
     mustend = time.time() + timeout
     while time.time() < mustend:
@@ -153,6 +517,12 @@ def base_data(context, path, mocked_data):
         context.mocker.get(url, status_code=200, content=asd.read())
 
 
+@given("base data {path} fails with a connection error")
+def base_data_fails(context, path):
+    start_mock(context)
+    context.mocker.get(f"https://api.themoviedb.org/3{path}", exc=requests.exceptions.ConnectionError)
+
+
 def start_mock(context):
     if not hasattr(context, 'mocker'):
         context.mocker = requests_mock.Mocker()
@@ -190,6 +560,7 @@ def clean_before(context):
     SpokenLanguage.objects.all().delete()
     Genre.objects.all().delete()
     WatchProvider.objects.all().delete()
+    bump_reference_data_version()
 
 
 @then('{movie_id} should have "fetched" set to "False"')
@@ -229,6 +600,28 @@ def expect_imdb_ratings_be_set(context, imdb_id, average_rating):
                                                        f"{movie.imdb_vote_count}")
 
 
+@step('the ratings row "{row}" is imported')
+def ratings_row_imported(context, row):
+    import_imdb_ratings_task([row.split(' ')])
+
+
+@step("the titles of {file} are imported again")
+def titles_imported_again(context, file):
+    with open(f"testdata/{file}", encoding='utf-8') as titles:
+        rows = list(csv.reader(titles, delimiter='\t', quoting=csv.QUOTE_NONE))[1:]
+    import_imdb_titles_task(rows)
+
+
+@then("id={movie_id} should have been last updated {when} {date}")
+def last_updated_relative_to(context, movie_id, when, date):
+    expected = datetime.datetime.fromisoformat(date)
+    updated_date = Movie.objects.get(pk=int(movie_id)).updated_date
+    if when == 'on':
+        context.test.assertEqual(updated_date, expected, f"Movie with id={movie_id} should not have been updated")
+    else:
+        context.test.assertGreater(updated_date, expected, f"Movie with id={movie_id} should have been updated")
+
+
 @step("imdb_id={imdb_id} should have imdb_alt_titles \"{expected_titles}\" set eventually")
 def expect_alt_titles_be_set_to(context, imdb_id, expected_titles):
     context.test.assertTrue(
@@ -242,6 +635,12 @@ def expect_alt_titles_be_set_to(context, imdb_id, expected_titles):
     context.test.assertEqual(set(expected_titles.split(',')), set(actual_titles))
 
 
+@then("id={movie_id} should have a tombstone")
+def has_tombstone(context, movie_id):
+    context.test.assertEqual(DeletedMovie.objects.filter(pk=int(movie_id)).count(), 1,
+                             f"Movie with id={movie_id} should have been tombstoned for the search index")
+
+
 @then("id={movie_id} should have alt_titles set eventually")
 def expect_alt_titles_be_set_at_all(context, movie_id):
     context.test.assertTrue(
@@ -254,6 +653,23 @@ def expect_alt_titles_be_set_at_all(context, movie_id):
     context.test.assertTrue(actual_titles)
 
 
+@then("the weighted rating prior should have been recomputed eventually")
+def rating_prior_recomputed(context):
+    context.test.assertTrue(wait_function_is_true(RatingPrior.objects, 1),
+                            "The weighted rating prior should have been recomputed after the ratings import")
+
+
+@then("id={movie_id} should have weighted_rating set to {weighted_rating} eventually")
+def expect_weighted_rating(context, movie_id, weighted_rating):
+    expected = float(weighted_rating)
+    context.test.assertTrue(
+        wait_function_is_true(Movie.objects.filter(pk=int(movie_id),
+                                                   weighted_rating__gt=expected - 0.01,
+                                                   weighted_rating__lt=expected + 0.01), 1),
+        f"Movie with id={movie_id} should have weighted_rating {weighted_rating}, "
+        f"but was: {Movie.objects.get(pk=int(movie_id)).weighted_rating}")
+
+
 @then("id={movie_id} should have country set to {guessed_country} eventually")
 def expect_guessed_country(context, movie_id, guessed_country):
     context.test.assertTrue(
@@ -289,3 +705,146 @@ def imdb_id_should_not_be_found(context, imdb_id):
         context.test.fail("Should have thrown DoesNotExist error here")
     except DoesNotExist:
         pass
+
+
+def new_rate_limiter(context, **kwargs):
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    context.add_cleanup(os.remove, path)
+    context.rate_limiter = RateLimiter(path, **kwargs)
+
+
+@given("a rate limiter at {rate} requests per second with a burst of {burst}")
+def rate_limiter_with_burst(context, rate, burst):
+    new_rate_limiter(context, rate=float(rate), burst=int(burst))
+
+
+@given("a rate limiter at {rate} requests per second, capped at {max_rate}")
+def rate_limiter_with_cap(context, rate, max_rate):
+    new_rate_limiter(context, rate=float(rate), max_rate=float(max_rate))
+
+
+@step("a 429 with Retry-After {seconds} is reported")
+def throttled(context, seconds):
+    context.rate_limiter.feedback(latency=0.1, throttled=True, retry_after=int(seconds))
+
+
+@step("{amount} quick successes are reported")
+def quick_successes(context, amount):
+    for _ in range(int(amount)):
+        context.rate_limiter.feedback(latency=0.1)
+
+
+@then("the rate should be {rate}")
+def rate_should_be(context, rate):
+    context.test.assertAlmostEqual(context.rate_limiter.rate, float(rate), delta=0.01)
+
+
+@then("another caller sharing the limiter should wait at least {seconds} seconds")
+def other_caller_waits(context, seconds):
+    other = RateLimiter(context.rate_limiter.path, rate=context.rate_limiter.initial_rate)
+    context.test.assertGreaterEqual(other.reserve(), float(seconds))
+
+
+@then("the next {amount} reservations should not wait")
+def reservations_do_not_wait(context, amount):
+    for _ in range(int(amount)):
+        context.test.assertEqual(context.rate_limiter.reserve(), 0.0)
+
+
+@then("the next reservation should wait {seconds} seconds")
+def reservation_waits(context, seconds):
+    context.test.assertAlmostEqual(context.rate_limiter.reserve(), float(seconds), delta=0.01)
+
+
+@step("id={movie_id} was last updated on {date}")
+def last_updated(context, movie_id, date):
+    Movie._get_collection().update_one({'_id': int(movie_id)},
+                                       {'$set': {'updated_date': datetime.datetime.fromisoformat(date)}})
+
+
+@given("the search index watermark is at {date}")
+def watermark_at(context, date):
+    save_watermark(datetime.datetime.fromisoformat(date))
+
+
+@given("id={movie_id} was deleted from mongo")
+def deleted_from_mongo(context, movie_id):
+    record_deleted_movies([int(movie_id)])
+
+
+@given("meilisearch is mocked")
+def meilisearch_mocked(context):
+    patcher = patch('apps.app.search_index.client')
+    context.meilisearch = patcher.start()
+    context.add_cleanup(patcher.stop)
+
+
+@then("the search index watermark should have moved to {date} eventually")
+def watermark_moved(context, date):
+    expected = datetime.datetime.fromisoformat(date)
+    context.test.assertTrue(
+        wait_function_is_true(SearchIndexState.objects.filter(pk=MOVIES_INDEX, watermark=expected), 1),
+        f"The watermark should have moved to {date}, but is at {get_watermark()}")
+
+
+@given("the search index is leased by another run until {date}")
+def search_index_leased(context, date):
+    SearchIndexState._get_collection().update_one(
+        {'_id': MOVIES_INDEX},
+        {'$set': {'leased_by': 'another-run', 'lease_expiry': datetime.datetime.fromisoformat(date)}}, upsert=True)
+
+
+@when("the changed movies are indexed")
+def changed_movies_indexed(context):
+    context.indexed, _ = index_changed_movies()
+
+
+@then("{indexed} movies should have been indexed")
+def movies_indexed(context, indexed):
+    context.test.assertEqual(context.indexed, int(indexed))
+
+
+@then("meilisearch should have been sent id={movie_id} only")
+def meilisearch_sent(context, movie_id):
+    index = context.meilisearch.index.return_value
+    sent = [document['id'] for call in index.add_documents.call_args_list for document in call.args[0]]
+    context.test.assertEqual(sent, [int(movie_id)])
+
+
+@then("meilisearch should have been asked to delete id={movie_id}")
+def meilisearch_deleted(context, movie_id):
+    context.meilisearch.index.return_value.delete_documents.assert_called_once_with([int(movie_id)])
+
+
+@then("there should be no tombstones left")
+def no_tombstones(context):
+    context.test.assertEqual(DeletedMovie.objects.count(), 0)
+
+
+@then('a Retry-After of "{header}" should hold back for {seconds} seconds')
+def retry_after_parsed(context, header, seconds):
+    context.test.assertEqual(parse_retry_after(header), int(seconds))
+
+
+REFERENCE_COLLECTIONS = (Genre, SpokenLanguage, ProductionCountries, WatchProvider)
+
+
+@when("movies {movie_ids} are served with a cold reference data cache")
+def served_with_cold_cache(context, movie_ids):
+    names = {document_class._get_collection_name() for document_class in REFERENCE_COLLECTIONS}
+    bump_reference_data_version()
+    with patch.object(Collection, 'find', autospec=True, side_effect=Collection.find) as find:
+        response = context.test.client.get(f"/movies/{movie_ids}")
+    context.test.assertEqual(response.status_code, 200)
+    context.test.assertEqual(len(json.loads(response.content)), len(movie_ids.split(',')))
+    context.reference_queries = [call.args[0].name for call in find.call_args_list if call.args[0].name in names]
+
+
+@then("serving them should take at most {queries} queries per reference collection")
+def constant_reference_queries(context, queries):
+    # Reloading the cache, and looking up whatever it lacks for the whole batch, however many movies there are
+    context.test.assertTrue(context.reference_queries, "The cold cache should have been reloaded")
+    for document_class in REFERENCE_COLLECTIONS:
+        context.test.assertLessEqual(context.reference_queries.count(document_class._get_collection_name()),
+                                     int(queries), context.reference_queries)
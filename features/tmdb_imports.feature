@@ -15,21 +15,211 @@ Feature: TMDB Imports
       | []                                                          | 3      |
       | [{"id": 604, "fetched": false},{"id": 605, "fetched":true}] | 4      |
 
+  Scenario: Daily Import Of Ids Already Persisted
+    Given movies "[{"id": 601, "fetched": false},{"id": 602, "fetched": true}]" is persisted
+    And tmdb file is mocked with movie_ids.json.gz
+    When calling /import/tmdb/daily
+    Then http status should be 200
+    And after awhile there should be 3 movies persisted
+    And id=601 should be persisted with fetched=False
+    And id=602 should be persisted with fetched=True
+
+  Scenario: Daily Import Drops Movies Missing From The Export
+    Given movies "[{"id": 604, "fetched": false},{"id": 605, "fetched": true}]" is persisted
+    And tmdb file is mocked with movie_ids.json.gz
+    When calling /import/tmdb/daily
+    Then http status should be 200
+    And after awhile there should be 4 movies persisted
+    And id=604 should not be persisted
+    And id=605 should be persisted with fetched=True
+
+  Scenario: Daily Import Keeps Fetched Movies Missing From The Export Discoverable
+    Given movies "[{"id": 605, "fetched": true}]" is persisted
+    And a stale discovery movie with id=605 is persisted
+    And tmdb file is mocked with movie_ids.json.gz
+    When calling /import/tmdb/daily
+    Then http status should be 200
+    And after awhile there should be 4 movies persisted
+    And id=605 should be persisted with fetched=True
+    And id=605 should still be in discovery
+
+  Scenario: Movie Stubs Skip Ids Already Persisted
+    Given movies "[{"id": 601, "fetched": true}]" is persisted
+    When movie stubs for ids 601,602,603 are inserted
+    Then 2 movie stubs should have been inserted
+    And after awhile there should be 3 movies persisted
+    And id=601 should be persisted with fetched=True
+
   Scenario Outline: Data Import
     Given movies "<json>" is persisted
+    And the fetch backend is <backend>
     And tmdb data is mocked with <mocked_data> for id <id> with status <status>
     When calling /import/tmdb/data
     Then http status should be 200
     And after awhile there should be <amount> movies persisted
     And id=<id> should have alt_titles set eventually
+    And id=<id> should not be leased anymore
 
     Examples: Happy Cases
-      | json                                                         | mocked_data        | id    | status | amount |
-      | [{"id": 601, "fetched": false}]                              | 601.json           | 601   | 200    | 1      |
-      | [{"id": 601, "fetched": false},{"id": 602, "fetched": true}] | 601.json           | 601   | 200    | 2      |
-      | [{"id": 601, "fetched": false}]                              | 601.json           | 601   | 200    | 1      |
-      | [{"id": 19995, "fetched": false}]                            | failing_movie.json | 19995 | 200    | 1      |
-      #| [{"id": 123, "fetched": false}]                              | 601.json           | 123   | 404    | 0      |
+      | json                                                         | mocked_data        | id    | status | amount | backend |
+      | [{"id": 601, "fetched": false}]                              | 601.json           | 601   | 200    | 1      | threads |
+      | [{"id": 601, "fetched": false},{"id": 602, "fetched": true}] | 601.json           | 601   | 200    | 2      | threads |
+      | [{"id": 601, "fetched": false}]                              | 601.json           | 601   | 200    | 1      | threads |
+      | [{"id": 19995, "fetched": false}]                            | failing_movie.json | 19995 | 200    | 1      | threads |
+
+    Examples: Happy Cases With Asyncio
+      | json                                                         | mocked_data        | id    | status | amount | backend |
+      | [{"id": 601, "fetched": false}]                              | 601.json           | 601   | 200    | 1      | asyncio |
+      | [{"id": 601, "fetched": false},{"id": 602, "fetched": true}] | 601.json           | 601   | 200    | 2      | asyncio |
+      | [{"id": 601, "fetched": false}]                              | 601.json           | 601   | 200    | 1      | asyncio |
+      | [{"id": 19995, "fetched": false}]                            | failing_movie.json | 19995 | 200    | 1      | asyncio |
+
+  Scenario Outline: Data Import Of A Movie Gone From TMDB
+    Given movies "[{"id": 123, "fetched": false}]" is persisted
+    And the fetch backend is <backend>
+    And tmdb data is mocked with 601.json for id 123 with status 404
+    When calling /import/tmdb/data
+    Then http status should be 200
+    And after awhile there should be 0 movies persisted
+    And id=123 should have a tombstone
+
+    Examples: Backends
+      | backend |
+      | threads |
+      | asyncio |
+
+  Scenario Outline: Failing Fetches Are Dead Lettered And Re-driven
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    And fetches give up after 2 quick attempts
+    And the fetch backend is <backend>
+    And tmdb data is mocked with 601.json for id 601 with status 500
+    When calling /import/tmdb/data
+    Then http status should be 200
+    And id=601 should be dead lettered and parked eventually
+    And claimer A should get nothing
+    When calling /redo/deadletters
+    Then http status should be 200
+    And id=601 should be claimable again eventually
+
+    Examples: Backends
+      | backend |
+      | threads |
+      | asyncio |
+
+  Scenario: Racing Claimers Never Get The Same Movie
+    Given 20 unfetched movies are persisted
+    When two claimers race for them 3 at a time
+    Then every movie should have been claimed exactly once
+
+  Scenario: Movies Are Claimed In Priority Order
+    Given movies "[{"id": 604, "fetched": false},{"id": 605, "fetched": true}]" is persisted
+    When the export is reconciled with the popularities "701:1,702:500,703:50"
+    Then claiming one movie at a time should hand out 702,703,701,604
+
+  Scenario: An Expired Lease Makes The Movie Claimable Again
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    When claimer A leases every movie for 1 seconds
+    Then claimer B should get nothing
+    And claimer B should get id=601 once the lease has run out
+
+  Scenario Outline: Data Import With A Storage Profile
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    And the storage profile is <profile>
+    And tmdb data is mocked with 601.json for id 601 with status 200
+    When calling /import/tmdb/data
+    Then http status should be 200
+    And id=601 should be stored with the <profile> profile, <cast> cast and <crew> crew members eventually
+    And id=601 should have changed since the last search indexing
+
+    Examples: Profiles
+      | profile | cast | crew |
+      | full    | 13   | 22   |
+      | minimal | 5    | 1    |
+
+
+  Scenario: Data Import With Split Movie Details
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    And movie details are split out
+    And tmdb data is mocked with 601.json for id 601 with status 200
+    When calling /import/tmdb/data
+    Then http status should be 200
+    And id=601 should have its credits in movie_details, 13 cast and 22 crew members eventually
+
+
+  Scenario Outline: Data Import Keeps Discovery Up To Date
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    And movie details <split>
+    And tmdb data is mocked with 601.json for id 601 with status 200
+    When calling /import/tmdb/data
+    Then http status should be 200
+    And id=601 should be discoverable from US in 1982, directed by Steven Spielberg eventually
+
+    Examples: Layouts
+      | split              |
+      | are split out      |
+      | stay on the movie  |
+
+
+  Scenario Outline: Discovery Rebuild
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    And movie details <split>
+    And tmdb data is mocked with 601.json for id 601 with status 200
+    When calling /import/tmdb/data
+    And id=601 should be discoverable from US in 1982, directed by Steven Spielberg eventually
+    And discovery is emptied
+    And calling /redo/populatediscovery?mode=<mode>
+    Then http status should be 200
+    And id=601 should be discoverable from US in 1982, directed by Steven Spielberg eventually
+
+    Examples: Modes
+      | mode   | split              |
+      | tasks  | stay on the movie  |
+      | merge  | stay on the movie  |
+      | merge  | are split out      |
+      | shadow | stay on the movie  |
+
+  Scenario: Shadow Discovery Rebuild Drops Stale Rows
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    And tmdb data is mocked with 601.json for id 601 with status 200
+    When calling /import/tmdb/data
+    And id=601 should be discoverable from US in 1982, directed by Steven Spielberg eventually
+    And a stale discovery movie with id=999 is persisted
+    And calling /redo/populatediscovery?mode=shadow
+    Then http status should be 200
+    And discovery should only hold id=601 eventually
+
+  Scenario: Shadow Discovery Rebuild Keeps Movies Written While It Ran
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    And tmdb data is mocked with 601.json for id 601 with status 200
+    When calling /import/tmdb/data
+    And id=601 should be discoverable from US in 1982, directed by Steven Spielberg eventually
+    And discovery is rebuilt in a shadow while id=601 is moved to SE
+    Then id=601 should be discoverable from SE in 1982, directed by Steven Spielberg eventually
+
+
+  Scenario: Discovery Chunks Skip Movies That Don't Belong In Discovery
+    Given movies from file:601.json is persisted
+    And movies "[{"id": 602, "fetched": false}]" is persisted
+    And discovery is emptied
+    When the discovery chunk 601,602 is populated
+    Then 1 movie should have been written to discovery and 1 skipped
+    And discovery should only hold id=601 eventually
+
+
+  Scenario: Archived Responses Replay Into An Empty Database Without Overwriting Newer Fetches
+    Given movies "[{"id": 601, "fetched": false}]" is persisted
+    And raw tmdb responses are archived
+    And tmdb data is mocked with 601.json for id 601 with status 200
+    When calling /import/tmdb/data
+    Then id=601 should have alt_titles set eventually
+    And the archive should hold id=601 eventually
+    When movies are removed from mongo
+    And the archive is replayed
+    Then id=601 should have alt_titles set eventually
+    And id=601 should be discoverable from US in 1982, directed by Steven Spielberg eventually
+    When id=601 is fetched again with the title "Newer"
+    And the archive is replayed
+    Then id=601 should still have the title "Newer"
 
 
   Scenario Outline: Base Import
@@ -74,3 +264,22 @@ Feature: TMDB Imports
     Examples:
       | amount | id     |
       | 1      | 578908 |
+
+  Scenario: Check TMDB For Changes On All Pages
+    Given movies "[{"id": 578908, "fetched": true, "fetched_date": "2018-01-01"}]" is persisted
+    And base data /movie/changes?api_key=test&start_date=2019-01-01&end_date=2019-01-02&page=1 is mocked with tmdb_changes_page_1.json
+    And base data /movie/changes?api_key=test&start_date=2019-01-01&end_date=2019-01-02&page=2 is mocked with tmdb_changes_page_2.json
+    When calling /import/tmdb/changes?start_date=2019-01-01&end_date=2019-01-02
+    Then http status should be 200
+    And after awhile there should be 2 movies persisted
+    And 578908 should have "fetched" set to "False"
+    And 601 should have "fetched" set to "False"
+
+  Scenario: Check TMDB For Changes Skips A Failing Page
+    Given movies "[{"id": 578908, "fetched": true, "fetched_date": "2018-01-01"}, {"id": 601, "fetched": true, "fetched_date": "2018-01-01"}]" is persisted
+    And base data /movie/changes?api_key=test&start_date=2019-01-01&end_date=2019-01-02&page=1 is mocked with tmdb_changes_page_1.json
+    And base data /movie/changes?api_key=test&start_date=2019-01-01&end_date=2019-01-02&page=2 fails with a connection error
+    When calling /import/tmdb/changes?start_date=2019-01-01&end_date=2019-01-02
+    Then http status should be 200
+    And 578908 should have "fetched" set to "False"
+    And id=601 should be persisted with fetched=True
@@ -18,6 +18,12 @@ Feature: Views
       | sjunde_inseglet.json | /view/random/best/0 | Det sjunde inseglet |
       | 1398.json            | /view/random/best/0 | tt0079944           |
 
+    Examples: /movies/ endpoint
+      | file                 | url              | expected                                      |
+      | sjunde_inseglet.json | /movies/490      | {"iso": "sv", "name": "Swedish"}              |
+      | sjunde_inseglet.json | /movies/490      | "provider_type": "flatrate", "name": "Max"    |
+      | 1398.json            | /movies/1398,490 | "title": "Stalker"                            |
+
   Scenario Outline: View Best Endpoint
     Given movies from file:<file> is persisted
     When calling <url>
@@ -28,3 +34,24 @@ Feature: Views
       | file                 | url         |
       | sjunde_inseglet.json | /movie/490  |
       | 1398.json            | /movie/1398 |
+
+  Scenario Outline: Reference Data Endpoints
+    When calling <url>
+    Then http status should be 200
+    And response should contain "<expected>"
+
+    Examples: served from the reference data cache
+      | url             | expected        |
+      | /genres         | Science Fiction |
+      | /dump/genres    | Science Fiction |
+      | /dump/langs     | Afrikaans       |
+      | /dump/countries | Andorra         |
+
+  Scenario: Serializing Movies Takes A Constant Number Of Reference Queries
+    Given movies from file:601.json is persisted
+    And movies from file:602.json is persisted
+    And movies from file:603.json is persisted
+    When movies 601 are served with a cold reference data cache
+    Then serving them should take at most 2 queries per reference collection
+    When movies 601,602,603 are served with a cold reference data cache
+    Then serving them should take at most 2 queries per reference collection
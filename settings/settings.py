@@ -66,8 +66,11 @@ CRONJOBS = [
     ('0 9 * * *', 'apps.tmdb.tmdb_importer.cron_endpoint_for_checking_updateable_movies', '>> /tmp/scheduled_job.log'),
     ('0 10 * * *', 'apps.tmdb.tmdb_importer.base_import', '>> /tmp/scheduled_job.log'),
     ('0 */2 * * *', 'apps.tmdb.tmdb_importer.fetch_tmdb_data_concurrently', '>> /tmp/scheduled_job.log'),
-    ('0 0 * * 1', 'apps.tmdb.tmdb_importer.populate_discovery_movies', '>> /tmp/scheduled_job.log'),
+    ('*/10 * * * *', 'apps.app.search_index.index_changed_movies', '>> /tmp/scheduled_job.log'),
+    # Discovery is kept up to date by every write, this full rebuild only repairs drift
+    ('0 0 1 * *', 'apps.tmdb.tmdb_importer.populate_discovery_movies', '>> /tmp/scheduled_job.log'),
     # IMDB
+    # Recomputes the weighted ratings once every chunk of the import is written
     ('0 1 * * *', 'apps.imdb.imdb_importer.import_imdb_ratings', '>> /tmp/scheduled_job.log'),
     ('0 0 * * 1', 'apps.imdb.imdb_importer.import_imdb_alt_titles', '>> /tmp/scheduled_job.log'),
 ]
@@ -105,6 +108,9 @@ ROOT_URLCONF = 'settings.urls'
 ASGI_APPLICATION = 'settings.asgi.application'
 BROKER_URL = CELERY_BROKER_URL
 REDIS_URL = os.environ.get('REDIS_CONNECTION', 'redis://redis')
+# Chords count their finished header tasks in the result backend
+CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', REDIS_URL)
+CELERY_RESULT_EXPIRES = int(os.environ.get('CELERY_RESULT_EXPIRES', 24 * 60 * 60))
 if 'test' in sys.argv or 'behave' in sys.argv:
     CHANNEL_LAYERS = {
         "default": {
@@ -137,6 +143,53 @@ else:
     mongoengine.connect('test', host=f"{mongo_url}")
 
 
+# ---------------- TMDB -----------------
+TMDB_RECONCILE_BATCH_SIZE = int(os.environ.get('TMDB_RECONCILE_BATCH_SIZE', 10000))
+# 'threads' or 'asyncio'
+TMDB_FETCH_BACKEND = os.environ.get('TMDB_FETCH_BACKEND', 'threads')
+TMDB_FETCH_THREADS = int(os.environ.get('TMDB_FETCH_THREADS', 5))
+# Maximum number of fetches submitted to the thread pool but not yet written
+TMDB_FETCH_WINDOW = int(os.environ.get('TMDB_FETCH_WINDOW', 20))
+TMDB_ASYNC_FETCH_CONCURRENCY = int(os.environ.get('TMDB_ASYNC_FETCH_CONCURRENCY', 50))
+# Unfetched movies are leased in batches, a lease not released before it expires is picked up by someone else
+TMDB_CLAIM_BATCH_SIZE = int(os.environ.get('TMDB_CLAIM_BATCH_SIZE', 500))
+TMDB_CLAIM_LEASE_SECONDS = int(os.environ.get('TMDB_CLAIM_LEASE_SECONDS', 1800))
+TMDB_WRITE_BATCH_SIZE = int(os.environ.get('TMDB_WRITE_BATCH_SIZE', 500))
+TMDB_WRITE_FLUSH_INTERVAL = float(os.environ.get('TMDB_WRITE_FLUSH_INTERVAL', 5))
+# Failed fetches are retried with jittered exponential backoff, then dead lettered
+TMDB_RETRY_MAX_ATTEMPTS = int(os.environ.get('TMDB_RETRY_MAX_ATTEMPTS', 5))
+TMDB_RETRY_BASE_SECONDS = float(os.environ.get('TMDB_RETRY_BASE_SECONDS', 2))
+TMDB_RETRY_MAX_SECONDS = float(os.environ.get('TMDB_RETRY_MAX_SECONDS', 300))
+# Directory for the raw response archive, archiving is off when unset
+TMDB_ARCHIVE_DIR = os.environ.get('TMDB_ARCHIVE_DIR', '')
+TMDB_ARCHIVE_SEGMENT_BYTES = int(os.environ.get('TMDB_ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024))
+TMDB_REPLAY_WORKERS = int(os.environ.get('TMDB_REPLAY_WORKERS', os.cpu_count() or 1))
+# How much of the credits and images to store per movie: full, compact or minimal, see STORAGE_PROFILES
+TMDB_STORAGE_PROFILE = os.environ.get('TMDB_STORAGE_PROFILE', 'full')
+# Store credits, images, providers and recommendations in movie_details instead of on the movie, see Movie.DETAIL_FIELDS
+TMDB_SPLIT_MOVIE_DETAILS = os.environ.get('TMDB_SPLIT_MOVIE_DETAILS', 'false').lower() == 'true'
+# Token bucket shared by every process on the host, requests per second adapting between min and max
+TMDB_RATE_LIMIT_FILE = os.environ.get('TMDB_RATE_LIMIT_FILE', '/tmp/tmdb_rate_limiter')
+TMDB_RATE_LIMIT = float(os.environ.get('TMDB_RATE_LIMIT', 20))
+TMDB_RATE_LIMIT_MIN = float(os.environ.get('TMDB_RATE_LIMIT_MIN', 1))
+TMDB_RATE_LIMIT_MAX = float(os.environ.get('TMDB_RATE_LIMIT_MAX', 45))
+TMDB_RATE_LIMIT_BURST = int(os.environ.get('TMDB_RATE_LIMIT_BURST', 10))
+
+# Movies per redo_countries task
+REDO_COUNTRIES_BATCH_SIZE = int(os.environ.get('REDO_COUNTRIES_BATCH_SIZE', 2000))
+# How populate_discovery_movies rebuilds discoverymovie, see DISCOVERY_REBUILD_MODES
+DISCOVERY_REBUILD_MODE = os.environ.get('DISCOVERY_REBUILD_MODE', 'tasks')
+# Id ranges the merge rebuild is split into, each merged by its own celery task
+DISCOVERY_MERGE_PARTITIONS = int(os.environ.get('DISCOVERY_MERGE_PARTITIONS', 16))
+# Id ranges the shadow rebuild merges at a time
+DISCOVERY_SHADOW_WORKERS = int(os.environ.get('DISCOVERY_SHADOW_WORKERS', 4))
+
+# Movies per meilisearch push of index_changed_movies, and how far back of its watermark it looks
+SEARCH_INDEX_BATCH_SIZE = int(os.environ.get('SEARCH_INDEX_BATCH_SIZE', 500))
+SEARCH_INDEX_OVERLAP_SECONDS = int(os.environ.get('SEARCH_INDEX_OVERLAP_SECONDS', 60))
+# How long a run of index_changed_movies holds the index before another run may take over, renewed every batch
+SEARCH_INDEX_LEASE_SECONDS = int(os.environ.get('SEARCH_INDEX_LEASE_SECONDS', 15 * 60))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -6,6 +6,8 @@ urlpatterns = [
     path('import/tmdb/daily',               views.download_file),
     # Starts to fetch info from tmdb with the keys from daily
     path('import/tmdb/data',                views.import_tmdb_data),
+    # Same as /data, but split into Celery tasks that lease their movies
+    path('import/tmdb/data/distributed',    views.import_tmdb_data_distributed),
     # Runs /daily, /genres, /countries, /languages
     path('import/base',                     views.base_fetch),
     path('import/tmdb/genres',              views.fetch_genres),
@@ -15,6 +17,7 @@ urlpatterns = [
     path('import/tmdb/changes',             views.check_tmdb_for_changes),
 
     path('index/movies',                    views.index_meilisearch),
+    path('index/movies/changes',            views.index_meilisearch_changes),
     path('search/movies/<str:query>',       views.search_movies),
 
     # IMDB
@@ -28,6 +31,11 @@ urlpatterns = [
     path('dump/langs',                      views.dump_langs),
     path('dump/countries',                  views.dump_countries),
     path('redo/guestimation',               views.redo_guestimation),
+    path('redo/weightedratings',            views.redo_weighted_ratings),
+    # Puts movies that ran out of fetch attempts back in the queue
+    path('redo/deadletters',                views.redrive_failed_fetches),
+    # Reprocesses the raw TMDB response archive without calling TMDB
+    path('redo/replay',                     views.replay_tmdb_archive),
     path('view/best/<str:country_code>',    views.get_best_movies_from_country),
     path('view/random/<str:country_code>',  views.get_random_movies_by_country),
     path('view/random/best/<int:movies>',   views.get_best_randoms),